@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# Cheap copies of unpacked source trees.
+#
+# dep-src builds every package in up to four copies of its source (.original,
+# .dpkg, .make and .vararg), which for big sources is gigabytes of copying
+# before anything compiles. The copies share their data with the tree they
+# were made from instead:
+#
+#   reflink   files are cloned with FICLONE and share extents until written
+#             (btrfs, xfs with reflink=1, bcachefs)
+#   overlay   the copy is an overlayfs mount over the source tree, written
+#             files go to DST.upper (needs root)
+#   copy      plain copy
+#   hardlink  files are hard links to the source tree, except small files,
+#             autotools helpers and everything under debian/, which are
+#             copied. Only on request: a write to a linked file in place (cp
+#             onto it, a shell redirection, a compiler or generator rewriting
+#             it) changes the source tree and every copy that shares it.
+#
+# "auto" uses reflinks where the filesystem supports them, else an overlay
+# when running as root, else a plain copy.
+
+import errno
+import fcntl
+import os
+import os.path
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+
+MODES = ["auto", "reflink", "hardlink", "overlay", "copy"]
+
+FICLONE = 0x40049409
+NO_REFLINK = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF}
+
+# Makefiles, config headers and friends are small, copying them costs little
+LINK_MIN_SIZE = 64 << 10
+# overwritten with cp, dh_update_autotools_config or libtoolize
+REWRITTEN = {"config.guess", "config.sub", "ltmain.sh", "install-sh", "missing", "depcomp", "compile"}
+REWRITTEN_DIRS = {"debian"}
+
+
+def reflink(src, dst):
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        os.unlink(dst)
+        raise
+    shutil.copystat(src, dst)
+
+
+def probe_reflink(src, dst_dir):
+    # tries to clone the first file of src next to where the copy goes, None
+    # when src has no file to try
+    for root, dirs, names in os.walk(src):
+        for n in names:
+            path = os.path.join(root, n)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            fd, probe = tempfile.mkstemp(prefix='.reflink.', dir=dst_dir)
+            try:
+                with os.fdopen(fd, 'wb') as d, open(path, 'rb') as s:
+                    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except OSError as e:
+                if e.errno not in NO_REFLINK:
+                    raise
+                return False
+            finally:
+                try:
+                    os.unlink(probe)
+                except OSError:
+                    pass
+            return True
+    return None
+
+
+# (source device, destination directory) -> whether reflinks work there.
+# dep-src clones trees from several build threads at once.
+_reflinks = {}
+_reflinks_lock = threading.Lock()
+
+def can_reflink(src, dst_dir):
+    key = (os.stat(src).st_dev, os.path.realpath(dst_dir))
+    with _reflinks_lock:
+        if key not in _reflinks:
+            works = probe_reflink(src, dst_dir)
+            if works is None:
+                return False
+            _reflinks[key] = works
+        return _reflinks[key]
+
+
+class Cloner:
+    # copy_function for shutil.copytree. links maps (device, inode) of
+    # already copied files to their copy, so files hard-linked in the source
+    # trees stay hard-linked in the copies.
+    def __init__(self, root, mode, links=None):
+        self.root = root
+        self.mode = mode
+        self.links = links
+        self.counts = {}
+
+    def rewritten(self, src, st):
+        if st.st_size < LINK_MIN_SIZE or os.path.basename(src) in REWRITTEN:
+            return True
+        parts = os.path.relpath(src, self.root).split(os.sep)
+        return any(p in REWRITTEN_DIRS for p in parts[:-1])
+
+    def count(self, how):
+        self.counts[how] = self.counts.get(how, 0) + 1
+
+    def __call__(self, src, dst):
+        st = os.stat(src)
+        key = (st.st_dev, st.st_ino)
+        if self.links is not None and st.st_nlink > 1 and key in self.links:
+            try:
+                os.link(self.links[key], dst)
+                self.count("hardlink")
+                return dst
+            except OSError:
+                pass
+
+        if self.mode == "reflink":
+            try:
+                reflink(src, dst)
+                self.count("reflink")
+                self.remember(key, st, dst)
+                return dst
+            except OSError as e:
+                if e.errno not in NO_REFLINK:
+                    raise
+                self.mode = "copy"
+
+        if self.mode == "hardlink" and not self.rewritten(src, st):
+            try:
+                os.link(src, dst)
+                self.count("hardlink")
+                return dst
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+
+        shutil.copy2(src, dst)
+        self.count("copy")
+        self.remember(key, st, dst)
+        return dst
+
+    def remember(self, key, st, dst):
+        if self.links is not None and st.st_nlink > 1:
+            self.links.setdefault(key, dst)
+
+
+# overlays mounted by this process, unmount_overlays() takes them down when
+# it is done with them
+_mounts = []
+_mounts_lock = threading.Lock()
+
+def overlay_dirs(dst):
+    return dst + ".upper", dst + ".work"
+
+
+def mount_overlay(src, dst):
+    upper, work = overlay_dirs(dst)
+    for d in [upper, work, dst]:
+        os.makedirs(d, exist_ok=True)
+    opts = "lowerdir={},upperdir={},workdir={}".format(os.path.abspath(src), os.path.abspath(upper), os.path.abspath(work))
+    out = subprocess.run(['mount', '-t', 'overlay', 'overlay', '-o', opts, dst], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if out.returncode != 0:
+        return False
+    with _mounts_lock:
+        _mounts.append(os.path.abspath(dst))
+    return True
+
+
+def remount(src, dst):
+    # mounts the overlay at dst again after it was unmounted, True if it did
+    if os.path.isdir(overlay_dirs(dst)[0]) and not os.path.ismount(dst):
+        return mount_overlay(src, dst)
+    return False
+
+
+def unmount(dst):
+    with _mounts_lock:
+        if os.path.abspath(dst) in _mounts:
+            _mounts.remove(os.path.abspath(dst))
+    return subprocess.call(['umount', dst]) == 0
+
+
+def unmount_overlays():
+    # unmounts the overlays this process mounted, newest first, and returns
+    # the ones that would not unmount. Their upper directories stay, so
+    # clone_tree and remount mount them again.
+    with _mounts_lock:
+        mounts = _mounts[::-1]
+        del _mounts[:]
+    return [d for d in mounts if os.path.ismount(d) and subprocess.call(['umount', d]) != 0]
+
+
+def clone_tree(src, dst, mode="auto"):
+    # Copies src to dst and returns how the files were copied, e.g.
+    # {"reflink": 1200, "copy": 3}, or {"overlay": 1}. Raises
+    # FileExistsError like shutil.copytree when dst exists, remounting
+    # an overlay whose mount went away first.
+    if os.path.exists(dst):
+        remount(src, dst)
+        raise FileExistsError(errno.EEXIST, "File exists", dst)
+
+    if mode == "auto":
+        if can_reflink(src, os.path.dirname(os.path.abspath(dst))):
+            mode = "reflink"
+        elif os.geteuid() == 0:
+            mode = "overlay"
+        else:
+            mode = "copy"
+
+    if mode == "overlay":
+        if mount_overlay(src, dst):
+            return {"overlay": 1}
+        remove_tree(dst)
+        mode = "copy"
+
+    cloner = Cloner(src, mode)
+    shutil.copytree(src, dst, symlinks=True, copy_function=cloner)
+    return cloner.counts
+
+
+def copy_tree(src, dst, links):
+    # copy to another filesystem, keeping files shared between the trees
+    # copied with the same links shared at the destination as well
+    cloner = Cloner(src, "reflink", links)
+    shutil.copytree(src, dst, symlinks=True, copy_function=cloner)
+    return cloner.counts
+
+
+def remove_tree(dst):
+    if os.path.ismount(dst):
+        unmount(dst)
+    for d in [dst] + list(overlay_dirs(dst)):
+        if os.path.lexists(d):
+            shutil.rmtree(d)
+
+
+def tree_usage(paths):
+    # [(path, files, bytes, own bytes)] where own bytes are the disk blocks
+    # of files no earlier path shares by hard link. Overlay trees own what is
+    # in their upper directory. Reflinked files are counted in full, their
+    # sharing is not visible to stat.
+    seen = set()
+    rows = []
+    for path in paths:
+        files = size = own = 0
+        upper = overlay_dirs(path)[0]
+        for root, dirs, names in os.walk(path):
+            for n in names:
+                st = os.lstat(os.path.join(root, n))
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                files += 1
+                size += st.st_size
+                key = (st.st_dev, st.st_ino)
+                if not os.path.isdir(upper) and key not in seen:
+                    seen.add(key)
+                    own += st.st_blocks * 512
+        for root, dirs, names in os.walk(upper):
+            for n in names:
+                own += os.lstat(os.path.join(root, n)).st_blocks * 512
+        rows.append((path, files, size, own))
+    return rows
@@ -1,16 +1,37 @@
 #!/usr/bin/env python3
 
+import gzip
+import hashlib
 import json
+import lzma
+import os
 import os.path
+import subprocess
 import sys
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool
 from os import walk
 import logging
 
 from optparse import OptionParser 
 
+from depgraph import DepGraph, graph_file, is_fresh, open_store
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
+COMPRESSIONS = ['', '.lz4', '.gz', '.xz']
+CHUNK_SIZE = 1 << 22
+STANZA_FIELDS = {b'Package', b'Version', b'Depends', b'Recommends', b'Pre-Depends', b'Provides'}
+DEPENDENCY_FIELDS = [b'Depends', b'Recommends', b'Pre-Depends']
+FINGERPRINT_FIELDS = DEPENDENCY_FIELDS + [b'Provides']
+
 
 def load(filename):
     if os.path.exists(filename):
@@ -27,27 +48,196 @@ def save(deps, filename):
         json.dump(deps, f, indent=2)
 
 
-def get_package_file(distro, category, arch):
+def stanza_file(filename):
+    return '{}.stanzas.json'.format(os.path.splitext(filename)[0])
+
+
+def load_stanzas(filename):
+    if os.path.exists(stanza_file(filename)):
+        with open(stanza_file(filename), 'r') as f:
+            return json.load(f)
+    return None
+
+
+def save_stanzas(index, filename):
+    with open(stanza_file(filename), 'w') as f:
+        json.dump(index, f)
+
+
+def relations_file(filename):
+    return '{}.relations.json'.format(os.path.splitext(filename)[0])
+
+
+def load_relations(filename):
+    if os.path.exists(relations_file(filename)):
+        with open(relations_file(filename), 'r') as f:
+            return json.load(f)
+    return None
+
+
+def save_relations(relations, filename):
+    with open(relations_file(filename), 'w') as f:
+        json.dump(relations, f)
+
+
+def load_installed(filename):
+    # installed.json style list, or a dpkg status file
+    if filename.endswith('.json'):
+        with open(filename, 'r') as f:
+            return set(json.load(f))
+
+    installed = set()
+    with open(filename, 'r', errors='replace') as f:
+        name = None
+        for line in f:
+            if line.startswith('Package:'):
+                name = line[len('Package:'):].strip()
+            elif line.startswith('Status:') and line.split()[-1] == 'installed' and name is not None:
+                installed.add(name)
+            elif line.strip() == '':
+                name = None
+    return installed
+
+
+def resolve(relations, installed, recommends):
+    # pick one real package per dependency clause: an installed alternative
+    # (or provider of a virtual one) first, then the first real one
+    providers = {}
+    for name, rels in relations.items():
+        for virtual in rels['provides']:
+            providers.setdefault(virtual, []).append(name)
+
+    deps = {}
+    for name, rels in relations.items():
+        clauses = rels['depends'] + (rels['recommends'] if recommends else [])
+        picked = []
+        for clause in clauses:
+            candidates = []
+            for alt in clause:
+                if alt in relations:
+                    candidates.append(alt)
+                candidates.extend(providers.get(alt, []))
+
+            choice = next((c for c in candidates if c in installed), None)
+            if choice is None:
+                choice = candidates[0] if len(candidates) > 0 else clause[0]
+            if choice not in picked:
+                picked.append(choice)
+        deps[name] = picked
+
+    return deps
+
+
+def rdeps_file(filename):
+    return '{}.rdeps.json'.format(os.path.splitext(filename)[0])
+
+
+def load_rdeps(graph, filename):
+    # the persisted index is reused as long as it is newer than the deps-file
+    rfile = rdeps_file(filename)
+    if os.path.exists(rfile) and os.path.exists(filename) and \
+            os.path.getmtime(rfile) >= os.path.getmtime(filename):
+        with open(rfile, 'r') as f:
+            return DepGraph.from_deps(json.load(f))
+
+    rgraph = graph.reverse()
+    with open(rfile, 'w') as f:
+        json.dump(rgraph.to_deps(), f, indent=2)
+    return rgraph
+
+
+def patch_rdeps(filename, deps, old_deps):
+    rfile = rdeps_file(filename)
+    if not os.path.exists(rfile):
+        return
+
+    with open(rfile, 'r') as f:
+        rdeps = json.load(f)
+
+    for name, depends in old_deps.items():
+        for d in depends:
+            if d in rdeps and name in rdeps[d]:
+                rdeps[d].remove(name)
+                if len(rdeps[d]) == 0:
+                    del rdeps[d]
+    for name in old_deps:
+        for d in deps.get(name, []):
+            if name not in rdeps.setdefault(d, []):
+                rdeps[d].append(name)
+
+    with open(rfile, 'w') as f:
+        json.dump(rdeps, f, indent=2)
+
+
+def refresh_closures(out_dir, graph, rgraph, modified):
+    # a closure can only change if it reaches a modified package in the new
+    # graph: the first modified package on any old path is still reachable
+    affected = set(modified)
+    for name, closure in rgraph.closures(sorted(modified)):
+        affected.update(closure)
+
+    refreshed = 0
+    for name in affected:
+        path = os.path.join(out_dir, name + '.dep')
+        if not os.path.exists(path):
+            continue
+        with open(path, 'w') as f:
+            for p in sorted(graph.closure(name)):
+                f.write('{}\n'.format(p))
+        refreshed += 1
+
+    log.info('Refreshed {} of {} affected dependency lists'.format(refreshed, len(affected)))
+
+
+def get_package_files(distros, categories, archs, mirror):
     try:
         base_dir, _, file_list = next(walk('/var/lib/apt/lists'))
     except StopIteration:
         logging.error('Cannot access: /var/lib/apt/lists')
         sys.exit(-1)
 
-    suffix = '_{}_{}_binary-{}_Packages'.format(distro, category, arch)
-
-    for file in file_list:
-        if file.endswith(suffix):
-            # make sure debian repo, not 3rd-party
-            if file.find("fir01.seas.upenn.edu") != -1:
-                return '{}/{}'.format(base_dir, file)
-
-    for file in file_list:
-        if file.find(suffix):
-            log.error("Please uncompress the file: {}".format(file))
-            sys.exit(-1)
-
-    return ''
+    package_files = []
+    for distro in distros:
+        for category in categories:
+            for arch in archs:
+                suffix = '_{}_{}_binary-{}_Packages'.format(distro, category, arch)
+                found = ''
+                # prefer the plain file, apt may keep a compressed copy next to it
+                for ext in COMPRESSIONS:
+                    for file in file_list:
+                        # make sure debian repo, not 3rd-party
+                        if file.endswith(suffix + ext) and file.find(mirror) != -1:
+                            found = '{}/{}'.format(base_dir, file)
+                            break
+                    if found != '':
+                        break
+
+                if found == '':
+                    log.warning('No Packages file for {}/{}/{}'.format(distro, category, arch))
+                else:
+                    package_files.append(found)
+
+    return package_files
+
+
+@contextmanager
+def open_package_file(package_file):
+    if package_file.endswith('.xz'):
+        with lzma.open(package_file, 'rb') as f:
+            yield f
+    elif package_file.endswith('.gz'):
+        with gzip.open(package_file, 'rb') as f:
+            yield f
+    elif package_file.endswith('.lz4'):
+        if lz4frame is not None:
+            with lz4frame.open(package_file, 'rb') as f:
+                yield f
+        else:
+            with subprocess.Popen(['lz4', '-dc', package_file], stdout=subprocess.PIPE) as p:
+                yield p.stdout
+    else:
+        with open(package_file, 'rb') as f:
+            yield f
 
 
 def parse_package_list(packages_str):
@@ -56,87 +246,362 @@ def parse_package_list(packages_str):
         package_name = package_info.split()[0].strip()
         packages.append(package_name)
 
-    log.debug('Dep-packages: {}'.format(packages))
     return packages
 
 
-def fetch(deps, distro, category, arch):
-    package_file = get_package_file(distro, category, arch)
-    log.info('Building deps: {}'.format(package_file))
-
-    if len(package_file) == 0:
+def parse_stanza(stanza):
+    fields = {}
+    current = None
+    for line in stanza.split(b'\n'):
+        if line[:1] in (b' ', b'\t'):
+            # continuation of a folded field
+            if current is not None:
+                fields[current] += b' ' + line.strip()
+            continue
+        key, sep, value = line.partition(b':')
+        if sep and key in STANZA_FIELDS:
+            current = key
+            fields[current] = value.strip()
+        else:
+            current = None
+
+    return fields
+
+
+def read_stanzas(infile):
+    # yields (offset, length, fields) with offsets into the uncompressed stream
+    buf = b''
+    buf_offset = 0
+    while True:
+        chunk = infile.read(CHUNK_SIZE)
+        if chunk:
+            buf += chunk
+        elif len(buf) == 0:
+            break
+
+        start = 0
+        while True:
+            end = buf.find(b'\n\n', start)
+            if end == -1:
+                if chunk:
+                    break
+                end = len(buf)
+
+            stanza = buf[start:end]
+            if stanza.strip():
+                # skip stray blank lines so offsets point at the first field
+                skipped = len(stanza) - len(stanza.lstrip(b'\n'))
+                stanza = stanza[skipped:]
+                yield buf_offset + start + skipped, len(stanza), parse_stanza(stanza)
+
+            start = end + 2
+            if start >= len(buf):
+                break
+
+        start = min(start, len(buf))
+        buf_offset += start
+        buf = buf[start:]
+        if not chunk:
+            break
+
+
+def parse_relation_list(relations_str):
+    clauses = []
+    for clause in relations_str.split(','):
+        alts = []
+        for alt in clause.split('|'):
+            tokens = alt.split()
+            if len(tokens) == 0:
+                continue
+            # drop architecture qualifiers such as python3:any
+            alts.append(tokens[0].split(':')[0])
+        if len(alts) > 0:
+            clauses.append(alts)
+    return clauses
+
+
+def stanza_relations(fields):
+    def clauses(*names):
+        result = []
+        for field in names:
+            if field in fields:
+                result.extend(parse_relation_list(fields[field].decode('utf-8', errors='replace')))
+        return result
+
+    provides = [alts[0] for alts in clauses(b'Provides')]
+    return {'depends': clauses(b'Pre-Depends', b'Depends'), 'recommends': clauses(b'Recommends'),
+            'provides': provides}
+
+
+def merge_relations(relations_list):
+    merged = {'depends': [], 'recommends': [], 'provides': []}
+    for rels in relations_list:
+        for key, values in rels.items():
+            for v in values:
+                if v not in merged[key]:
+                    merged[key].append(v)
+    return merged
+
+
+def stanza_depends(fields):
+    depends = []
+    for field in DEPENDENCY_FIELDS:
+        if field in fields:
+            depends.extend(parse_package_list(fields[field].decode('utf-8', errors='replace')))
+    return depends
+
+
+def fingerprint(fields):
+    h = hashlib.sha1()
+    for field in FINGERPRINT_FIELDS:
+        h.update(fields.get(field, b''))
+        h.update(b'\n')
+    return h.hexdigest()[:16]
+
+
+def parse_package_file(package_file):
+    # name -> (depends, [file, offset, length, version, fingerprint], relations),
+    # the last stanza wins when a name is duplicated inside one file
+    packages = {}
+    with open_package_file(package_file) as infile:
+        for offset, length, fields in read_stanzas(infile):
+            if b'Package' not in fields:
+                log.error("Something wrong in 'Packages' file format. (Offset={})".format(offset))
+                sys.exit(-1)
+
+            name = fields[b'Package'].decode('utf-8', errors='replace')
+            if name in packages:
+                log.warn('Duplicated package name: {}'.format(name))
+
+            version = fields.get(b'Version', b'').decode('utf-8', errors='replace')
+            packages[name] = (stanza_depends(fields),
+                              [package_file, offset, length, version, fingerprint(fields)],
+                              stanza_relations(fields))
+
+    return package_file, packages
+
+
+def parse_package_files(package_files, jobs):
+    for package_file in package_files:
+        log.info('Building deps: {}'.format(package_file))
+
+    if jobs > 1 and len(package_files) > 1:
+        with Pool(min(jobs, len(package_files))) as pool:
+            return dict(pool.map(parse_package_file, package_files))
+    return dict(map(parse_package_file, package_files))
+
+
+def file_stamp(package_file):
+    st = os.stat(package_file)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def merge_depends(depends_lists):
+    # the same package from another suite or architecture adds its edges
+    merged = []
+    seen = set()
+    for depends in depends_lists:
+        for d in depends:
+            if d not in seen:
+                seen.add(d)
+                merged.append(d)
+    return merged
+
+
+def fetch(deps, package_files, jobs):
+    if len(package_files) == 0:
         log.error("Matched 'Packages' file not found. Please run 'apt-get update', then retry.")
         sys.exit(-1)
 
-    with open(package_file, 'rt', errors='replace') as infile:
-        line_no = 0
-        current_package = ''
-        for line in infile:
-            line_no += 1
-            tokens = line.strip().split()
+    results = parse_package_files(package_files, jobs)
+
+    found = {}
+    for package_file in package_files:
+        for name, (depends, entry, rels) in results[package_file].items():
+            depends_lists, entries, relations_list = found.setdefault(name, ([], [], []))
+            depends_lists.append(depends)
+            entries.append(entry)
+            relations_list.append(rels)
+
+    index = {'files': {f: file_stamp(f) for f in package_files}, 'packages': {}}
+    relations = {}
+    for name, (depends_lists, entries, relations_list) in found.items():
+        deps[name] = merge_depends(depends_lists)
+        index['packages'][name] = entries
+        relations[name] = merge_relations(relations_list)
+
+    return deps, index, relations
+
+
+def read_stanzas_at(package_file, entries):
+    # re-read single stanzas of an unchanged file through the saved offsets
+    fields = {}
+    with open_package_file(package_file) as infile:
+        pos = 0
+        for entry in sorted(entries, key=lambda e: e[1]):
+            offset, length = entry[1], entry[2]
+            if package_file.endswith(tuple(e for e in COMPRESSIONS if e)):
+                while pos < offset:
+                    pos += len(infile.read(min(CHUNK_SIZE, offset - pos)))
+            else:
+                infile.seek(offset)
+            data = infile.read(length)
+            pos = offset + len(data)
+            fields[offset] = parse_stanza(data)
+    return fields
+
+
+def update(deps, relations, index, package_files, jobs):
+    # re-parse only the lists whose size or mtime changed, and only touch the
+    # packages whose stanza fingerprints differ from the saved ones
+    stamps = {f: file_stamp(f) for f in package_files}
+    changed = [f for f in package_files if index['files'].get(f) != stamps[f]]
+    gone = set(f for f in index['files'] if f not in stamps) | set(changed)
+    log.info('Changed Packages files: {}'.format(len(changed)))
+
+    results = parse_package_files(changed, jobs)
+
+    candidates = set()
+    for name, entries in index['packages'].items():
+        if any(e[0] in gone for e in entries):
+            candidates.add(name)
+    for package_file in changed:
+        candidates.update(results[package_file])
+
+    order = {f: i for i, f in enumerate(package_files)}
+    modified = set()
+    reread = {}
+    new_entries = {}
+    for name in candidates:
+        old = index['packages'].get(name, [])
+        kept = [e for e in old if e[0] not in gone]
+        fresh = [results[f][name][1] for f in changed if name in results[f]]
+        entries = sorted(kept + fresh, key=lambda e: order[e[0]])
+        new_entries[name] = entries
+
+        def key(e):
+            return e[0], e[3], e[4]
+        if name in deps and sorted(map(key, old)) == sorted(map(key, entries)):
+            continue
+        modified.add(name)
+        for e in kept:
+            reread.setdefault(e[0], []).append(e)
+
+    stanzas = {}
+    for package_file, entries in reread.items():
+        for offset, fields in read_stanzas_at(package_file, entries).items():
+            stanzas[(package_file, offset)] = fields
+
+    added, removed, updated = [], [], []
+    patched = {}
+    for name in modified:
+        entries = new_entries[name]
+        if len(entries) == 0:
+            if name in deps:
+                removed.append(name)
+            relations.pop(name, None)
+            continue
+
+        depends_lists = []
+        relations_list = []
+        for e in entries:
+            if e[0] in results:
+                depends_lists.append(results[e[0]][name][0])
+                relations_list.append(results[e[0]][name][2])
+            else:
+                depends_lists.append(stanza_depends(stanzas[(e[0], e[1])]))
+                relations_list.append(stanza_relations(stanzas[(e[0], e[1])]))
+        depends = merge_depends(depends_lists)
+        relations[name] = merge_relations(relations_list)
+
+        if name not in deps:
+            added.append(name)
+        elif depends != deps[name]:
+            updated.append(name)
+        patched[name] = depends
+
+    old_deps = {name: deps[name] for name in removed + updated}
+    for name in removed:
+        del deps[name]
+    for name, depends in patched.items():
+        deps[name] = depends
+
+    for name, entries in new_entries.items():
+        if len(entries) == 0:
+            index['packages'].pop(name, None)
+        else:
+            index['packages'][name] = entries
+    index['files'] = stamps
 
-            if len(tokens) == 0:
-                # end of package
-                current_package = ''
-                continue
+    log.info('Added {}, removed {}, changed {} packages'.format(len(added), len(removed), len(updated)))
+    return deps, relations, index, old_deps, added
 
-            category = tokens[0].strip()
 
-            if category == 'Package:':
-                if current_package != '':
-                    log.error("Something wrong in 'Packages'' file format. (Line={})".format(line_no))
-                    sys.exit(-1)
+def search(name, graph):
+    trans_deps = graph.closure(name)
+    with open(name + '.dep', 'w') as f:
+        for p in sorted(trans_deps):
+            f.write('{}\n'.format(p))
 
-                current_package = tokens[1].strip()
-                if current_package in deps:
-                    log.warn('Duplicated package name: {}'.format(current_package))
 
-                deps[current_package] = []
-            elif category in ['Depends:', 'Recommends:', 'Pre-Depends:']:
-                if current_package == '':
-                    log.error('Depends for empty package. (Line={})'.format(line_no))
-                    sys.exit(-1)
+def search_rdeps(names, rgraph):
+    # everything that transitively depends on any of names
+    trans_rdeps = set()
+    for name, closure in rgraph.closures(names):
+        if name not in rgraph.index:
+            log.warning('Unknown package: {}'.format(name))
+        trans_rdeps.update(closure)
 
-                deps[current_package].extend(parse_package_list(' '.join(tokens[1:])))
+    with open(names[0] + '.rdep', 'w') as f:
+        for p in sorted(trans_rdeps):
+            f.write('{}\n'.format(p))
 
-    return deps
 
+def read_batch(filename):
+    if filename == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(filename, 'r') as f:
+            lines = f.read().splitlines()
 
-def fixpt(deps, works, results):
-    if len(works) == 0:
-        return results
-    w = works.pop()
-    try:
-        directs = deps[w]
-    except:
-        directs = set()
-    for d in directs:
-        if d in results:
+    names = []
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
             continue
+        names.append(line)
+    return names
+
+
+def search_batch(names, graph, out_dir, jsonl):
+    start = time.time()
+    if jsonl is not None:
+        out = sys.stdout if jsonl == '-' else open(jsonl, 'w')
+
+    for name, trans_deps in graph.closures(names):
+        if name not in graph.index:
+            log.warning('Unknown package: {}'.format(name))
+        if jsonl is not None:
+            out.write(json.dumps({'package': name, 'deps': sorted(trans_deps)}) + '\n')
         else:
-            works.update(directs)
-            results.update(directs)
-    return fixpt(deps, works, results)
+            with open(os.path.join(out_dir, name + '.dep'), 'w') as f:
+                for p in sorted(trans_deps):
+                    f.write('{}\n'.format(p))
 
+    if jsonl is not None and out is not sys.stdout:
+        out.close()
 
-def search(name, deps):
-    works = set()
-    works.add(name)
-    results = set()
-    trans_deps = fixpt(deps, works, results)
-    with open(name + '.dep', 'w') as f:
-        for p in sorted(trans_deps):
-            f.write('{}\n'.format(p))
+    elapsed = time.time() - start
+    log.info('Closures for {} packages in {:.3f} sec ({:.3f} ms/package)'.format(
+        len(names), elapsed, 1000 * elapsed / max(len(names), 1)))
 
 
-def stats(deps, g, trans):
+def stats(deps, graph):
     size_table = list(map(lambda x: (x, len(deps[x])), deps))
     size_table.sort(key=lambda x: x[1], reverse=True)
 
-    trans_size_table = []
-    v_prop = g.vertex_properties['info']
-    for v in trans.vertices():
-        trans_size_table.append((v_prop[v]['label'], len(list(v.out_edges()))))
+    sizes = graph.closure_sizes()
+    trans_size_table = list(zip(graph.names, sizes))
     trans_size_table.sort(key=lambda x: x[1], reverse=True)
 
     with open('direct.txt', 'w') as f:
@@ -156,29 +621,121 @@ def stats(deps, g, trans):
 
 parser = OptionParser()
 parser.add_option('-p', '--package', dest='package', help='build a dependency list for PACKAGE', metavar='PACKAGE')
+parser.add_option('-b', '--batch', dest='batch', metavar='FILE',
+                  help='build dependency lists for every package listed in FILE (- for stdin)')
+parser.add_option('-o', '--out-dir', dest='out_dir', default='.', metavar='DIR',
+                  help='Write batch .dep files to DIR. [default: %default]')
+parser.add_option('--jsonl', dest='jsonl', metavar='FILE',
+                  help='Write batch results to one JSONL FILE (- for stdout) instead of .dep files')
+parser.add_option('--rdeps', dest='rdeps', action='append', metavar='PACKAGE',
+                  help='list every package depending on PACKAGE in PACKAGE.rdep (repeat to union several)')
+parser.add_option('-R', '--resolve', action='store_true', default=False,
+                  help='Resolve alternatives and virtual packages for queries. [default: %default]')
+parser.add_option('-i', '--installed', dest='installed', metavar='FILE',
+                  help='Prefer alternatives installed according to FILE (installed.json style list or dpkg status)')
+parser.add_option('--no-recommends', action='store_true', default=False,
+                  help='Do not follow Recommends when resolving. [default: %default]')
+parser.add_option('-s', '--stats', action='store_true', default=False,
+                  help='Write direct.txt and transitive.txt. [default: %default]')
 parser.add_option('-f', '--file', default='deps.json',
                   help='Name of deps-file. [default: %default]')
 parser.add_option('-r', '--rebuild', action='store_true', default=False,
                   help='Rebuild deps-file. [default: %default]')
+parser.add_option('-u', '--update', action='store_true', default=False,
+                  help='Patch deps-file with the packages changed since the last build. [default: %default]')
 parser.add_option('-d', '--distro', default='buster',
-                  help='Linux distribution (required only for building deps-file). [default: %default]')
+                  help='Comma-separated Linux distributions (required only for building deps-file). [default: %default]')
 parser.add_option('-c', '--category', default='main',
-                  help='Package category (required only for building deps-file).  [default: %default]')
+                  help='Comma-separated package categories (required only for building deps-file).  [default: %default]')
 parser.add_option('-a', '--arch', default='amd64',
-                  help='Architecture (required only for building deps-file). [default: %default]')
+                  help='Comma-separated architectures (required only for building deps-file). [default: %default]')
+parser.add_option('-m', '--mirror', default='fir01.seas.upenn.edu',
+                  help='Only use Packages files from MIRROR. [default: %default]', metavar='MIRROR')
+parser.add_option('-l', '--list', dest='lists', action='append', default=[],
+                  help='Read PACKAGES file (plain, .xz, .gz or .lz4) instead of searching apt lists', metavar='PACKAGES')
+parser.add_option('-j', '--jobs', type='int', default=os.cpu_count(),
+                  help='Number of Packages files parsed in parallel. [default: %default]')
 
 (options, args) = parser.parse_args()
 
-deps, need_init = load(options.file)
+graph = None
+store = graph_file(options.file)
+if not options.rebuild and not options.update and os.path.exists(options.file) and is_fresh(store, options.file):
+    # queries only need the mmap'ed graph, skip parsing the json
+    graph = open_store(store)
+    deps, need_init = graph.deps(), False
+else:
+    deps, need_init = load(options.file)
 
 # reset if rebuild is True
 if options.rebuild:
     deps = {}
     need_init = True
 
+index = None
+relations = None
+if options.update and not need_init:
+    index = load_stanzas(options.file)
+    relations = load_relations(options.file)
+    if index is None or relations is None:
+        log.warning('No stanza index for {}, rebuilding'.format(options.file))
+        deps = {}
+        need_init = True
+
+if need_init or index is not None:
+    if len(options.lists) > 0:
+        package_files = options.lists
+    else:
+        package_files = get_package_files(options.distro.split(','), options.category.split(','),
+                                          options.arch.split(','), options.mirror)
+
+modified = set()
 if need_init:
-    deps = fetch(deps, options.distro, options.category, options.arch)
+    deps, index, relations = fetch(deps, package_files, options.jobs)
     save(deps, options.file)
+    save_stanzas(index, options.file)
+    save_relations(relations, options.file)
+elif index is not None:
+    deps, relations, index, old_deps, added = update(deps, relations, index, package_files, options.jobs)
+    modified = set(old_deps) | set(added)
+    if len(modified) > 0:
+        save(deps, options.file)
+        old_deps.update({name: [] for name in added})
+        patch_rdeps(options.file, deps, old_deps)
+    save_stanzas(index, options.file)
+    save_relations(relations, options.file)
+
+if graph is None:
+    graph = DepGraph.from_deps(deps)
+    if not is_fresh(store, options.file):
+        graph.save(store)
+
+rgraph = None
+if need_init or options.rdeps is not None or len(modified) > 0:
+    rgraph = load_rdeps(graph, options.file)
+
+if len(modified) > 0:
+    refresh_closures(options.out_dir, graph, rgraph, modified)
+
+if options.resolve:
+    if relations is None:
+        relations = load_relations(options.file)
+    if relations is None:
+        log.error('No relations for {}, rebuild it with -r'.format(options.file))
+        sys.exit(-1)
+    installed = load_installed(options.installed) if options.installed is not None else set()
+    graph = DepGraph.from_deps(resolve(relations, installed, not options.no_recommends))
+    if options.rdeps is not None:
+        rgraph = graph.reverse()
 
 if options.package is not None:
-    search(options.package, deps)
+    search(options.package, graph)
+
+if options.rdeps is not None:
+    search_rdeps(options.rdeps, rgraph)
+
+if options.batch is not None:
+    search_batch(read_batch(options.batch), graph, options.out_dir, options.jsonl)
+
+if options.stats:
+    stats(deps, graph)
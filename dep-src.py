@@ -5,12 +5,22 @@ import os.path
 import sys
 import glob
 import shutil
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 
 from optparse import OptionParser 
 
 import json
 import re
 
+import cowtree
+import elfsym
+import symdb
+
 REPO_HOME = os.path.dirname(os.path.realpath(__file__))
 COMPILATION_DB_DIR_PATH = os.path.join(REPO_HOME, "compilation_db")
 
@@ -30,10 +40,76 @@ VARARG=".vararg"
 
 options = {}
 
+# Source package name -> the binaries from the dependency list it builds. Each
+# source is downloaded and built once, under the name of its first binary.
+binaries = {}
+
+# Seconds of build time per byte of downloaded source, for packages that were
+# never built before
+SECONDS_PER_BYTE = 1e-5
+BUILD_TIMES = "build-times.json"
+
+# apt and dpkg hold a global lock, and the vararg symbols of every package go
+# into one symbols.txt/symbols.db
+apt_lock = threading.Lock()
+symbols_lock = threading.Lock()
+
+# Memory a compile job is budgeted when sizing the jobserver
+MEMORY_PER_JOB = 2 << 30
+
+jobserver = None
+
+# GNU make jobserver shared by every build: a pipe holding one token per job
+# slot. A make started with the pipe in MAKEFLAGS takes a token for each job
+# beyond its first, and every build takes one here for that first job, so all
+# builds together never run more jobs than there are slots.
+class JobServer:
+    def __init__(self, slots, builds):
+        self.slots = slots
+        self.r, self.w = os.pipe()
+        os.write(self.w, b'+' * slots)
+        # debhelper runs make -jN itself, which leaves the jobserver, so dpkg
+        # builds get a fixed share of the slots instead. It does not change
+        # while a build runs, so it has to hold with all builds running.
+        self.share = max(1, slots // builds)
+
+    def fds(self):
+        return (self.r, self.w)
+
+    def makeflags(self, flags):
+        flags = [f for f in flags.split() if not re.match(r'-j\d*$|--jobserver-(auth|fds)=', f)]
+        return " ".join(flags + ["-j", "--jobserver-auth={},{}".format(self.r, self.w)])
+
+    @contextmanager
+    def build(self, env):
+        # environment for one build, holding its first job's token
+        token = os.read(self.r, 1)
+        try:
+            env = env.copy()
+            env["MAKEFLAGS"] = self.makeflags(env.get("MAKEFLAGS", ""))
+            opts = [o for o in env.get("DEB_BUILD_OPTIONS", "").split() if not o.startswith("parallel=")]
+            env["DEB_BUILD_OPTIONS"] = " ".join(opts + ["parallel={}".format(self.share)])
+            yield env
+        finally:
+            os.write(self.w, token)
+
+# One slot per CPU, fewer if the available memory cannot feed them
+def jobserver_slots():
+    slots = os.cpu_count() or 1
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    available = int(l.split()[1]) * 1024
+                    slots = min(slots, max(1, available // MEMORY_PER_JOB))
+    except OSError:
+        pass
+    return slots
+
 LZLOAD_SYMBOL="__loadsym"
 VARARG_SYMBOL="__dummy__va"
 
-def dump_vararg_symbols(lib, f):
+def dump_vararg_symbols(lib, src, f, entries):
     soname = soname_lib(lib)
     symbols = readelf_grepped(lib, VARARG_SYMBOL)
     if symbols is None:
@@ -42,11 +118,19 @@ def dump_vararg_symbols(lib, f):
 
     for s in symbols:
         f.write("{} {}\n".format(s,soname))
-
-def generate_vararg_symbols(libs):
-    with open(os.path.join(options.working_dir,'symbols.txt'), 'a') as f:
-        for l in libs:
-            dump_vararg_symbols(l,f)
+        pair = (soname, src)
+        if pair not in entries.setdefault(s, []):
+            entries[s].append(pair)
+
+def generate_vararg_symbols(libs, src):
+    # symbols.db is rebuilt with the new symbols, symbols.txt stays append-only
+    db = symdb.db_file(options.working_dir)
+    with symbols_lock:
+        entries = symdb.open_db(db).entries() if os.path.exists(db) else {}
+        with open(symdb.text_file(options.working_dir), 'a') as f:
+            for l in libs:
+                dump_vararg_symbols(l,src,f,entries)
+        symdb.build(entries, db)
 
 def gather_libs(path):
     out = subprocess.run(['find',path, '-name', 'lib*.so*'], stdout=subprocess.PIPE)
@@ -64,32 +148,13 @@ def exec_find(path, name):
 
 
 def readelf_grepped(path, pattern):
-    readelf = subprocess.Popen(['readelf', '-Ws', path], stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
-    out = subprocess.run(['grep',pattern], stdout=subprocess.PIPE, stdin=readelf.stdout)
-
-    if out.stdout is None:
-        return None
-    
-    symbols = []
-    out = out.stdout.decode("utf-8")
-
-    for l in out.splitlines():
-        toks = l.split()
-        symbols.append(toks[-1])
-
-    return symbols 
+    return elfsym.grep_symbols(path, pattern)
 
 def check_elf(path, symbol):
-    readelf = subprocess.Popen(['readelf', '-Ws', path], stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
-    out = subprocess.run(['grep',symbol], stdout=subprocess.PIPE, stdin=readelf.stdout)
-    return len(out.stdout) > 0
+    return elfsym.has_symbol(path, symbol)
 
 def get_soname(path):
-    objdump = subprocess.Popen(['objdump', '-p', path], stdout=subprocess.PIPE)
-    out = subprocess.run(['grep','SONAME'], stdout=subprocess.PIPE, stdin=objdump.stdout)
-    if len(out.stdout) == 0:
-        return None
-    return out.stdout.strip().split()[-1] 
+    return elfsym.soname(path)
 
 def read_dependency_list(name):
     deps = {}
@@ -114,35 +179,68 @@ def download_src(dep):
         print(e) 
         return False 
 
-def download_srcs(deps):
-    srcs = []
+def binaries_of(src):
+    return binaries.get(src, [src])
 
+# binary -> source package, from the Source: field apt-cache reports
+def binary_sources(deps):
+    sources = {}
+    try:
+        out = subprocess.run(['apt-cache', 'show', '--no-all-versions'] + list(deps), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        print("\twarning: no source packages: {}".format(e))
+        return sources
+
+    for fields in read_stanzas(out.stdout.decode('utf-8', errors='replace')):
+        package = fields.get("Package")
+        if package and package not in sources:
+            # "Source: gnutls28 (3.6.7-4)" when the version differs
+            source = fields.get("Source", package).split()
+            sources[package] = source[0] if source else package
+    return sources
+
+# Binaries grouped by source package, in dependency-list order and named
+# after the first binary, so existing source trees and saved compilation dbs
+# keep their names
+def group_by_source(deps):
+    sources = binary_sources(deps)
+    groups = {}
+    names = {}
     for d in deps:
-        if exclude_src(d, EXCLUDES):
-            continue
+        name = names.setdefault(sources.get(d, d), d)
+        groups.setdefault(name, []).append(d)
+    for name, bins in groups.items():
+        if len(bins) > 1:
+            print("{} builds {}".format(name, ", ".join(bins)))
+    return groups
 
+def download_srcs(deps):
+    srcs = []
+
+    groups = group_by_source([d for d in deps if not exclude_src(d, EXCLUDES)])
+    for d in groups:
         print('fetching ' + d)
         if download_src(d):
             srcs.append(d)
+            binaries[d] = groups[d]
 
     return srcs
 
-def build_with_dpkg(path, env, parallel=False, binary_only=False):
+def build_with_dpkg(path, env, log, binary_only=False):
     opt = "-B" if binary_only else "-b"
     rc = subprocess.call(['dpkg-buildpackage', '-rfakeroot', '-Tclean'], stdout=log, stderr=subprocess.STDOUT, cwd=path)
-    if parallel:
-        rc = subprocess.call(['dpkg-buildpackage', '-us', '-uc', '-d', opt, '-j32'], stdout=log, stderr=subprocess.STDOUT, cwd=path, env=env)
-    else:
-        rc = subprocess.call(['dpkg-buildpackage', '-us', '-uc', '-d', opt], stdout=log, stderr=subprocess.STDOUT, cwd=path, env=env)
+    with jobserver.build(env) as build_env:
+        rc = subprocess.call(['dpkg-buildpackage', '-us', '-uc', '-d', opt], stdout=log, stderr=subprocess.STDOUT, cwd=path, env=build_env, pass_fds=jobserver.fds())
 
-def try_build_dep(src):
-    rc = subprocess.call(['apt-get', 'build-dep', '-y', src], stdout=log, stderr=subprocess.STDOUT)
-    if rc != 0:
-        rc = subprocess.call(['dpkg', '--configure', '-a'], stdout=log, stderr=subprocess.STDOUT)
+def try_build_dep(src, log):
+    with apt_lock:
         rc = subprocess.call(['apt-get', 'build-dep', '-y', src], stdout=log, stderr=subprocess.STDOUT)
+        if rc != 0:
+            rc = subprocess.call(['dpkg', '--configure', '-a'], stdout=log, stderr=subprocess.STDOUT)
+            rc = subprocess.call(['apt-get', 'build-dep', '-y', src], stdout=log, stderr=subprocess.STDOUT)
     return rc
 
-def build_original(src, env):
+def build_original(src, env, log):
     print("building original " + str(src))
 
     srchome = copy_src(os.path.join(options.working_dir, src), ORIGINAL, options.force)
@@ -159,7 +257,7 @@ def build_original(src, env):
     srcpath = dirs[0]
 
     # Install dependencies to building the make easier
-    if try_build_dep(src) != 0:
+    if try_build_dep(src, log) != 0:
         print("\twarning: issue building dependencies for {}".format(src)) 
 
     saved_command_db = os.path.join(*[COMPILATION_DB_DIR_PATH, src, "compile_commands.json"])
@@ -168,7 +266,7 @@ def build_original(src, env):
     if not reuse_saved_db or options.force:
         # Build the package normally first to get a compile_command.json
         env["DEB_BUILD_OPTIONS"] = "nocheck notest"
-        build_with_dpkg(srcpath, env)
+        build_with_dpkg(srcpath, env, log)
 
         # Check for compile_command.json, and then move to tmp file so the next build doesn't
         # overwrite it 
@@ -190,7 +288,7 @@ def build_original(src, env):
 def path_for(src, typ):
     return os.path.join(options.working_dir, src) + typ
 
-def build_vararg(src, env):
+def build_vararg(src, env, log):
     print("building vararg " + str(src))
 
     srchome = copy_src(os.path.join(options.working_dir, src), VARARG, options.force)
@@ -217,7 +315,7 @@ def build_vararg(src, env):
     if len(vararg_libs) > 0:
         return srcpath
 
-    build_with_dpkg(srcpath, vararg_env, binary_only=True)
+    build_with_dpkg(srcpath, vararg_env, log, binary_only=True)
 
     return srcpath
 
@@ -250,7 +348,7 @@ def check_vararg(libs):
     vararg_libs = [l for l in libs  if check_elf(l, VARARG_SYMBOL)]
     return vararg_libs
 
-def build_with_make(src, command_db, env, origpath):
+def build_with_make(src, command_db, env, origpath, log):
     # Try a re-fetch and clean build with make
     srchome = copy_src(os.path.join(options.working_dir, src), MAKE, False)
     dirs = [f.path for f in os.scandir(srchome) if f.is_dir() ]
@@ -268,15 +366,17 @@ def build_with_make(src, command_db, env, origpath):
         compile_env["COMPILE_COMMAND_DB"] = command_db
         if os.path.exists(os.path.join(srcpath, './configure')) and os.access(os.path.join(srcpath, './configure'), os.X_OK):
             command = ['./configure']
-            if src in CONFIG_OPTS:
-                command = command + CONFIG_OPTS[src]
+            # one configure has to cover every binary of the source
+            for b in binaries_of(src):
+                command = command + [o for o in CONFIG_OPTS.get(b, []) if o not in command]
             rc = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, cwd=srcpath, env=configure_env)
         elif os.path.exists(os.path.join(srcpath, './autogen.sh')):
             rc = subprocess.call(['./autogen.sh'], stdout=log, stderr=subprocess.STDOUT, cwd=srcpath, env=configure_env)
             rc = subprocess.call(['./configure'], stdout=log, stderr=subprocess.STDOUT, cwd=srcpath, env=configure_env)
 
         if os.path.exists(os.path.join(srcpath, './Makefile')):
-            rc = subprocess.call(['make', '-j32'], stdout=log, stderr=subprocess.STDOUT, cwd=srcpath, env=compile_env)
+            with jobserver.build(compile_env) as build_env:
+                rc = subprocess.call(['make'], stdout=log, stderr=subprocess.STDOUT, cwd=srcpath, env=build_env, pass_fds=jobserver.fds())
         else:
             print("\twarning: Makefile not found")
             return None
@@ -295,9 +395,9 @@ def find_unpacked_srcdir(path):
     dirs = [f.path for f in os.scandir(path) if f.is_dir() ]
     return dirs[0] 
 
-def build_dummy(src, command_db, env, origpath):
+def build_dummy(src, command_db, env, origpath, log):
     print("building dummy " + str(src))
-    if src in MAKE_ONLY:
+    if any(b in MAKE_ONLY for b in binaries_of(src)):
         return None
 
     srchome = copy_src(os.path.join(options.working_dir, src), DPKG, False)
@@ -314,7 +414,7 @@ def build_dummy(src, command_db, env, origpath):
         dummylib_env["DEB_LDFLAGS_APPEND"] = "-L/usr/local/lib -llzload"
         dummylib_env["DEB_BUILD_OPTIONS"] = "nocheck notest"
 
-        build_with_dpkg(srcpath, dummylib_env, parallel=True)
+        build_with_dpkg(srcpath, dummylib_env, log)
 
     ref_libs = gather_libs(origpath)
     dummy_libs = gather_libs(srcpath)
@@ -332,22 +432,36 @@ def build_dummy(src, command_db, env, origpath):
 def copy_src(path, ext, force):
     newpath = path + ext
     if os.path.exists(newpath) and force:
-        shutil.rmtree(newpath)
+        cowtree.remove_tree(newpath)
     try:
-        shutil.copytree(path, newpath, symlinks=True)
+        counts = cowtree.clone_tree(path, newpath, options.cow)
+        if options.verbose:
+            print("\tinfo: {} {}".format(newpath, ", ".join("{} {}".format(n, k) for k, n in sorted(counts.items()))))
     except FileExistsError:
         print("\twarning: {} exists".format(newpath))
         pass
     return newpath 
 
+def disk_usage(srcs):
+    # what every variant tree of a package takes on disk, own is what it
+    # does not share with the trees listed before it
+    total = 0
+    for s in srcs:
+        paths = [p for p in [path_for(s, t) for t in ["", ORIGINAL, DPKG, MAKE, VARARG]] if os.path.exists(p)]
+        if len(paths) == 0:
+            continue
+        print(s)
+        for path, files, size, own in cowtree.tree_usage(paths):
+            total += own
+            print("\t{:<40} {:>8} files {:>10.1f} MB {:>10.1f} MB own".format(os.path.basename(path), files, size / 2**20, own / 2**20))
+    print("Total: {:.1f} MB".format(total / 2**20))
+
 def trim_libname(libpath):
     return libpath.split("/")[-1]
 
 def soname_lib(libpath):
     soname = get_soname(libpath)
-    if soname is not None:
-        soname = soname.decode("utf-8")
-    else:
+    if soname is None:
         soname = trim_libname(libpath)
     return soname
 
@@ -430,7 +544,7 @@ def is_proper_deb(src, deb):
 def dpkg_install(src, modhome, debs):
     errored = False
     for d in debs:
-        if not is_proper_deb(src, d):
+        if not any(is_proper_deb(b, d) for b in binaries_of(src)):
             continue
         out = subprocess.run(['dpkg', '-x', d, modhome], stdout=subprocess.PIPE)
         if out.returncode == 0:
@@ -441,16 +555,16 @@ def dpkg_install(src, modhome, debs):
     return errored
 
 
-def build_src(src, libhome, modhome):
+def build_src(src, libhome, modhome, log):
     env = os.environ.copy()
-    command_db, origpath = build_original(src, env) 
+    command_db, origpath = build_original(src, env, log)
     if not command_db:
         return False, "none", False
 
     env["CC"] = os.path.join(env["KLLVM"], "build/bin/clang")
     env["CXX"] = os.path.join(env["KLLVM"], "build/bin/clang++")
 
-    libs = build_dummy(src, command_db, env, origpath)
+    libs = build_dummy(src, command_db, env, origpath, log)
 
     if libs is None:
         # If we didn't find libs with __get in the ELF files, we have
@@ -458,7 +572,7 @@ def build_src(src, libhome, modhome):
         if os.path.exists(os.path.join(origpath, "configure")) \
         or os.path.exists(os.path.join(origpath, "autogen.sh")) \
         or os.path.exists(os.path.join(origpath, "Makefile")):
-            libs = build_with_make(src, command_db, env, origpath)
+            libs = build_with_make(src, command_db, env, origpath, log)
         if libs is None:
             return False, "none", False
 
@@ -469,8 +583,8 @@ def build_src(src, libhome, modhome):
     vc = None
     vararg_type = "none"
     if len(vararg_libs) > 0:
-        generate_vararg_symbols(vararg_libs) 
-        varargpath = build_vararg(src, env)
+        generate_vararg_symbols(vararg_libs, src)
+        varargpath = build_vararg(src, env, log)
         debs = exec_find(path_for(src, VARARG), "*.deb")
         if len(debs) != 0:
             vc = dpkg_install(src, modhome, debs) 
@@ -481,6 +595,167 @@ def build_src(src, libhome, modhome):
 
     return True, vararg_type, vc
 
+def relation_names(field):
+    # package names in a Build-Depends style field, alternatives included
+    names = []
+    for rel in re.split(r'[,|]', field):
+        toks = rel.split()
+        if len(toks) > 0:
+            names.append(toks[0].split(':')[0])
+    return names
+
+def read_stanzas(text):
+    stanzas = []
+    fields = {}
+    key = None
+    for l in text.splitlines():
+        if not l.strip():
+            if fields:
+                stanzas.append(fields)
+            fields = {}
+            key = None
+        elif l[0].isspace() and key is not None:
+            fields[key] += " " + l.strip()
+        elif ':' in l:
+            key, value = l.split(':', 1)
+            fields[key] = value.strip()
+    if fields:
+        stanzas.append(fields)
+    return stanzas
+
+# src -> the other srcs it build-depends on. The names in the dependency list
+# are binary packages, matched against the Binary: field of their source, and
+# a build dependency on any binary of that source counts.
+def build_dependencies(srcs):
+    deps = {s: set() for s in srcs}
+    try:
+        out = subprocess.run(['apt-cache', 'showsrc'] + list(srcs), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        print("\twarning: no build dependencies: {}".format(e))
+        return deps
+
+    stanzas = {}
+    built_by = {}
+    for fields in read_stanzas(out.stdout.decode('utf-8', errors='replace')):
+        built = set(relation_names(fields.get("Binary", "")))
+        built.add(fields.get("Package", ""))
+        for s in srcs:
+            if s not in stanzas and any(b in built for b in binaries_of(s)):
+                stanzas[s] = fields
+                for b in built:
+                    built_by.setdefault(b, s)
+
+    for s, fields in stanzas.items():
+        names = []
+        for k in ["Build-Depends", "Build-Depends-Arch", "Build-Depends-Indep"]:
+            names += relation_names(fields.get(k, ""))
+        deps[s] = set(built_by[n] for n in names if n in built_by and built_by[n] != s)
+    return deps
+
+def load_build_times():
+    path = os.path.join(options.working_dir, BUILD_TIMES)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def save_build_times(times):
+    path = os.path.join(options.working_dir, BUILD_TIMES)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(times, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+# Seconds the last build of src took, or a guess from the size of its sources
+def build_cost(src, times):
+    if src in times:
+        return times[src]
+    size = 0
+    srchome = os.path.join(options.working_dir, src)
+    for f in os.scandir(srchome) if os.path.isdir(srchome) else []:
+        if f.is_file():
+            size += f.stat().st_size
+    return size * SECONDS_PER_BYTE
+
+# Cost of src plus the most expensive chain of builds waiting on it, so the
+# long chains start first. Computed in depth-first post-order with an explicit
+# stack, chains of thousands of packages do not recurse; edges back into the
+# current path (build dependency cycles) are ignored.
+def build_priorities(srcs, rdeps, cost):
+    prio = {}
+    for s in srcs:
+        if s in prio:
+            continue
+        path = {s}
+        stack = [(s, iter(rdeps[s]))]
+        while stack:
+            node, it = stack[-1]
+            for r in it:
+                if r not in prio and r not in path:
+                    path.add(r)
+                    stack.append((r, iter(rdeps[r])))
+                    break
+            else:
+                stack.pop()
+                path.discard(node)
+                prio[node] = cost[node] + max([prio[r] for r in rdeps[node] if r in prio], default=0)
+    return prio
+
+def build_logged(src, libhome, modhome):
+    start = time.time()
+    with open(os.path.join(options.working_dir, "logs", src + ".log"), "w") as log:
+        try:
+            result = build_src(src, libhome, modhome, log)
+        except Exception as e:
+            print("error: building {} failed: {}".format(src, e))
+            traceback.print_exc(file=log)
+            result = (False, "none", False)
+    return result, time.time() - start
+
+# Runs up to options.jobs builds at once. A package starts once the packages
+# it build-depends on have finished, the one with the longest chain of
+# expensive builds behind it first.
+def schedule_builds(srcs, libhome, modhome):
+    deps = build_dependencies(srcs)
+    times = load_build_times()
+    cost = {s: build_cost(s, times) for s in srcs}
+    rdeps = {s: [] for s in srcs}
+    for s in srcs:
+        for d in deps[s]:
+            rdeps[d].append(s)
+    prio = build_priorities(srcs, rdeps, cost)
+
+    waiting = {s: set(deps[s]) for s in srcs}
+    results = {}
+    with ThreadPoolExecutor(max_workers=options.jobs) as pool:
+        running = {}
+        while waiting or running:
+            ready = sorted([s for s in waiting if not waiting[s]], key=lambda s: -prio[s])
+            if not ready and not running:
+                # dependency cycle, start the member closest to being ready
+                ready = [min(waiting, key=lambda s: (len(waiting[s]), -prio[s]))]
+            for s in ready[:options.jobs - len(running)]:
+                del waiting[s]
+                print("scheduling {} (estimated {:.0f}s)".format(s, cost[s]))
+                running[pool.submit(build_logged, s, libhome, modhome)] = s
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                s = running.pop(f)
+                results[s], elapsed = f.result()
+                print("finished {} in {:.0f}s".format(s, elapsed))
+                # a failed build says little about how long a good one takes
+                if results[s][0]:
+                    times[s] = elapsed
+                for r in rdeps[s]:
+                    if r in waiting:
+                        waiting[r].discard(s)
+            save_build_times(times)
+    return results
+
 def build_srcs(srcs, pkg_name):
     libhome = os.path.join(options.working_dir, "lib")
     if not os.path.exists(libhome):
@@ -488,22 +763,29 @@ def build_srcs(srcs, pkg_name):
     modhome = os.path.join(options.working_dir, "mod-lib")
     if not os.path.exists(modhome):
         os.mkdir(modhome)
+    os.makedirs(os.path.join(options.working_dir, "logs"), exist_ok=True)
 
     env = os.environ.copy()
 
     if os.path.exists(os.path.join(options.working_dir, "symbols.txt")):
         os.remove(os.path.join(options.working_dir, "symbols.txt")) 
+    if os.path.exists(symdb.db_file(options.working_dir)):
+        os.remove(symdb.db_file(options.working_dir))
 
-    if not env["KLLVM"]:
+    if not env.get("KLLVM"):
         print("error: Set KLLVM to point to our modified LLVM installation")
         return
 
+    results = schedule_builds(srcs, libhome, modhome)
+
     stat = open(os.path.join(options.working_dir, pkg_name + '.stat'), "w")
     stat.write("package name, build, vararg-build, vararg-error\n")
 
+    # one row per binary, siblings share their source's result
     for s in srcs:
-        rc, vararg_type, vc = build_src(s, libhome, modhome)
-        stat.write("{}, {}, {}, {}\n".format(s, rc, vararg_type, vc))
+        rc, vararg_type, vc = results[s]
+        for b in binaries_of(s):
+            stat.write("{}, {}, {}, {}\n".format(b, rc, vararg_type, vc))
 
     stat.close()
         
@@ -677,6 +959,10 @@ parser.add_option('-c', '--check', dest='check', default=None, help='check again
 parser.add_option('-p', '--packages', dest='packages', default=None, help='path to packages.txt', metavar='PACKAGES')
 parser.add_option('-i', '--install', dest='install', action='store_true', help='install packages in dependency list')
 parser.add_option('-r', '--restore', dest='restore', action='store_true', help='restore build')
+parser.add_option('-C', '--cow', dest='cow', default='auto', choices=cowtree.MODES, help='make build trees with MODE: auto (reflink, else overlay as root, else copy), reflink, overlay, copy, or hardlink, where writing a linked file in place changes every tree that shares it (default: auto)', metavar='MODE')
+parser.add_option('-u', '--usage', dest='usage', action='store_true', help='report the disk usage of every build tree')
+parser.add_option('-J', '--job-slots', dest='job_slots', type='int', default=None, help='share SLOTS compile jobs between all builds (default: CPUs, fewer if memory is short)', metavar='SLOTS')
+parser.add_option('-j', '--jobs', dest='jobs', type='int', default=4, help='build up to JOBS packages at once, each logging to DIR/logs/PACKAGE.log', metavar='JOBS')
 
 (options, args) = parser.parse_args()
 
@@ -684,6 +970,16 @@ if options.restore is not None:
     restore()
     sys.exit(0) 
 
+if options.jobs < 1:
+    print("error: --jobs must be at least 1")
+    parser.print_usage()
+    sys.exit(1)
+
+if options.job_slots is not None and options.job_slots < 1:
+    print("error: --job-slots must be at least 1")
+    parser.print_usage()
+    sys.exit(1)
+
 if len(args) < 1:
     print("error: must supply dependency-list")
     parser.print_usage()
@@ -704,14 +1000,23 @@ if options.install is not None:
     install(deps, pkgname)
     sys.exit(0) 
 
-if options.scrape:
-    scrape_libs(srcs, pkgname)
+if options.usage:
+    groups = group_by_source([d for d in deps if not exclude_src(d, EXCLUDES)])
+    disk_usage(groups)
     sys.exit(0)
 
-log = open("build.log", "w")
+if options.scrape:
+    groups = group_by_source([d for d in deps if not exclude_src(d, EXCLUDES)])
+    scrape_libs([s for s in groups if os.path.exists(path_for(s, ""))], pkgname)
+    sys.exit(0)
 
-srcs=download_srcs(deps)
-build_srcs(srcs, pkgname)
+jobserver = JobServer(options.job_slots if options.job_slots is not None else jobserver_slots(), options.jobs)
+print("jobserver: {} job slots, parallel={} for dpkg builds".format(jobserver.slots, jobserver.share))
 
-log.close()
+try:
+    srcs=download_srcs(deps)
+    build_srcs(srcs, pkgname)
+finally:
+    for d in cowtree.unmount_overlays():
+        print("warning: could not unmount {}".format(d))
 
@@ -4,48 +4,129 @@ import subprocess
 import os.path
 import sys
 import glob
+import fcntl
+import hashlib
+import shutil
+import fnmatch
+import io
+import tarfile
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import Pool
 
 from optparse import OptionParser 
 
 import json
 
+import elfsym
+import symdb
+
 ARCH='x86_64-linux-gnu'
+DEB_ARCHS=["amd64", "all"]
+BATCH_SIZE=32
+MAX_SEGMENTS=8
+TRACE_CHUNK=1 << 26
+TRACE_CACHE=1 << 20
+LZLOAD_PATH=os.environ.get('LZLOAD_PATH', os.path.join(os.path.expanduser('~'), 'var', 'lib', 'lzload'))
 working_dir = ""
 
 EXCLUDES=["libc6", "libgcc1", "gcc-8-base", "<debconf-2.0>", "debconf"]
 
 # Really just for tracking a bit more about a symbol stored in our table
 class Symbol:
-    name = ""
-    libs = []
-    metas = []
+    __slots__ = ("name", "libs", "metas")
 
     def __init__(self,name,libs,metas):
         self.name = name
         self.libs = libs
         self.metas = metas
 
+# All exported symbols of the repository. Library names and packages are
+# interned to ids, and the library and package a symbol was first found in
+# live in two array columns indexed by symbol id. Symbols defined more than
+# once are rare, their other definitions go to a side table. Symbol records
+# are only built when asked for.
+class SymbolTable:
+    __slots__ = ("index", "libs", "lib_ids", "metas", "sym_lib", "sym_meta", "extra")
+
+    def __init__(self):
+        self.index = {}
+        self.libs = []
+        self.lib_ids = {}
+        self.metas = []
+        self.sym_lib = array('I')
+        self.sym_meta = array('I')
+        self.extra = {}
+
+    def intern_lib(self, lib):
+        l = self.lib_ids.get(lib)
+        if l is None:
+            l = self.lib_ids[lib] = len(self.libs)
+            self.libs.append(lib)
+        return l
+
+    # tables: [(lib, [symbol names])] as read from the package's symbols file
+    def add_package(self, meta, tables):
+        m = len(self.metas)
+        self.metas.append(meta)
+        for lib, names in tables:
+            meta.add_lib(lib)
+            l = self.intern_lib(lib)
+            for name in names:
+                i = self.index.get(name)
+                if i is None:
+                    self.index[name] = len(self.sym_lib)
+                    self.sym_lib.append(l)
+                    self.sym_meta.append(m)
+                else:
+                    # Possible conflict (really only an issue between packages for now)
+                    self.extra.setdefault(i, []).append((l, m))
+
+    def definitions(self, i):
+        return [(self.sym_lib[i], self.sym_meta[i])] + self.extra.get(i, [])
+
+    def get(self, name, default=None):
+        i = self.index.get(name)
+        if i is None:
+            return default
+        defs = self.definitions(i)
+        return Symbol(name, [self.libs[l] for l, _ in defs], [self.metas[m] for _, m in defs])
+
+    # (lib, package) pairs providing name, first definition first
+    def __getitem__(self, name):
+        defs = self.definitions(self.index[name])
+        return list(dict.fromkeys((self.libs[l], self.metas[m].package_name) for l, m in defs))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
 class Meta:
-    package_name = ""
-    package_deb = ""
-    has_symbols = False
-    shared_libs = []
+    __slots__ = ("package_name", "package_deb", "has_symbols", "shared_libs", "package_sha256")
 
-    def __init__(self,package_name,package_deb,has_symbols,shared_libs):
+    def __init__(self,package_name,package_deb,has_symbols,shared_libs,package_sha256=""):
         self.package_name = package_name
         self.package_deb = package_deb
         self.has_symbols = has_symbols
         self.shared_libs = shared_libs
+        self.package_sha256 = package_sha256
 
     def add_lib(self, lib):
         if lib not in self.shared_libs:
             self.shared_libs.append(lib)
 
     def json_state(self):
-        return self.__dict__
+        return {k: getattr(self, k) for k in Meta.__slots__}
 
     def as_meta(dct):
-        return Meta(dct["package_name"],dct["package_deb"],dct["has_symbols"],dct["shared_libs"])
+        return Meta(dct["package_name"],dct["package_deb"],dct["has_symbols"],dct["shared_libs"],dct.get("package_sha256", ""))
 
 class MetaEncoder(json.JSONEncoder):
 
@@ -63,113 +144,383 @@ def read_dependency_list(name):
             deps[d] = True
     return deps
 
-def download_deps(deps,metas):
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# SHA256 of the .deb apt would download for each package, taken from the
+# package index so unchanged packages are never fetched again
+def candidate_sha256(deps):
+    shas = {}
+    for i in range(0, len(deps), BATCH_SIZE):
+        try:
+            out = subprocess.run(['apt-cache', 'show', '--no-all-versions'] + deps[i:i + BATCH_SIZE],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            return shas
+        name = None
+        for l in out.stdout.decode('utf-8', errors='replace').splitlines():
+            if l.startswith('Package: '):
+                name = l.split()[1]
+            elif l.startswith('SHA256: ') and name is not None:
+                shas.setdefault(name, l.split()[1])
+    return shas
+
+# Symbol files are cached by the sha256 of the .deb they came from, so the
+# same package is only ever indexed once no matter which working directory
+# asks for it, and a new version of a package misses the cache on its own
+def cache_entry(sha256):
+    if options.cache is None or sha256 == "":
+        return None
+    return os.path.join(options.cache, sha256[:2], sha256)
+
+def cached(sha256):
+    entry = cache_entry(sha256)
+    return entry is not None and os.path.exists(os.path.join(entry, 'meta.json'))
+
+def restore_cached(sha256, debhome):
+    entry = cache_entry(sha256)
+    with open(os.path.join(entry, 'meta.json'), 'r') as f:
+        meta = json.load(f, object_hook=Meta.as_meta)
+    shutil.copy(os.path.join(entry, 'symbols'), os.path.join(debhome, 'symbols'))
+    return meta
+
+def store_cached(meta, debhome):
+    entry = cache_entry(meta.package_sha256)
+    if entry is None:
+        return
+    os.makedirs(entry, exist_ok=True)
+    # meta.json goes last, an entry without it is never read
+    tmp = os.path.join(entry, 'symbols.{}'.format(os.getpid()))
+    shutil.copy(os.path.join(debhome, 'symbols'), tmp)
+    os.replace(tmp, os.path.join(entry, 'symbols'))
+    tmp = os.path.join(entry, 'meta.json.{}'.format(os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(Meta(meta.package_name, meta.package_deb, True, [], meta.package_sha256), f, cls=MetaEncoder)
+    os.replace(tmp, os.path.join(entry, 'meta.json'))
+
+# apt names files NAME_VERSION_ARCH.deb, matching on the underscore keeps
+# libssl1.1 from picking up libssl1.1-dev
+def find_deb(d, path):
+    debs = glob.glob(os.path.join(path, glob.escape(d) + '_*.deb'))
+    if len(debs) == 0:
+        return None
+    return max(debs, key=os.path.getmtime)
+
+def apt_download(batch):
+    try:
+        subprocess.check_output(['apt-get', 'download'] + batch, stderr=subprocess.STDOUT, cwd=working_dir)
+        return batch, []
+    except subprocess.CalledProcessError:
+        if len(batch) == 1:
+            return [], batch
+
+    # One unknown package fails the whole batch, retry them one by one
+    fetched = []
+    failed = []
+    for d in batch:
+        ok, bad = apt_download([d])
+        fetched.extend(ok)
+        failed.extend(bad)
+    return fetched, failed
+
+def index_mirror(mirror):
     debs = {}
+    for root, _, files in os.walk(mirror):
+        for f in sorted(files):
+            toks = f[:-len('.deb')].split('_') if f.endswith('.deb') else []
+            if len(toks) == 3 and toks[2] in DEB_ARCHS:
+                debs[toks[0]] = os.path.join(root, f)
+    return debs
 
+def copy_from_mirror(d, path):
+    deb = os.path.basename(path)
+    dest = os.path.join(working_dir, deb)
+    try:
+        os.link(path, dest)
+    except OSError:
+        shutil.copy(path, dest)
+    return deb
+
+def up_to_date(d, sha256, metas):
+    return d in metas and sha256 is not None and metas[d].package_sha256 == sha256 \
+        and os.path.exists(os.path.join(working_dir, d))
+
+# Yields (package, deb, sha256) as soon as each batch is on disk, so
+# extraction can run while the rest is still downloading. deb is None when
+# the package is already in the symbol cache and was not downloaded at all.
+def download_deps(deps,metas):
+    if options.mirror is not None:
+        mirror = index_mirror(options.mirror)
+        for d in deps:
+            if d not in mirror:
+                print("No package found for " + d)
+                continue
+            sha256 = sha256_file(mirror[d])
+            if up_to_date(d, sha256, metas):
+                continue
+            if cached(sha256):
+                yield d, None, sha256
+                continue
+            yield d, copy_from_mirror(d, mirror[d]), sha256
+        return
+
+    shas = candidate_sha256(list(deps))
+    todo = []
     for d in deps:
-        if d in metas:
+        sha256 = shas.get(d)
+        if up_to_date(d, sha256, metas):
             continue
-
-        print('fetching ' + d)
-        try:
-            out = subprocess.check_output(['apt-get', 'download', d], stderr=subprocess.STDOUT)
-            deb = glob.glob(d + '*.deb')[0]
-            debs[d] = deb
-            os.rename(deb, working_dir + '/' + deb)
-        except:
-            print("No package found for " + d)
-
-    return debs
+        if sha256 is not None and cached(sha256):
+            yield d, None, sha256
+            continue
+        todo.append(d)
+
+    batches = [todo[i:i + BATCH_SIZE] for i in range(0, len(todo), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=options.jobs) as pool:
+        futures = []
+        for b in batches:
+            print('fetching ' + ' '.join(b))
+            futures.append(pool.submit(apt_download, b))
+
+        for future in as_completed(futures):
+            fetched, failed = future.result()
+            for d in failed:
+                print("No package found for " + d)
+            for d in fetched:
+                deb = find_deb(d, working_dir)
+                if deb is None:
+                    print("No package found for " + d)
+                    continue
+                yield d, os.path.basename(deb), sha256_file(deb)
 
 def trim_libname(libpath):
     return libpath.split("/")[-1].split('.')[0]
 
 def gather_libs(path):
-    out = subprocess.run(['find',path, '-name', 'lib*.so*'], stdout=subprocess.PIPE)
     libs = []
-    for l in out.stdout.splitlines():
-        libs.append(l.decode('utf-8'))
+    for root, dirs, files in os.walk(path):
+        for f in dirs + files:
+            if fnmatch.fnmatch(f, 'lib*.so*'):
+                libs.append(os.path.join(root, f))
     return libs
 
-def build_symbols(meta):
+# Minimal streaming reader for the ar archive wrapping a .deb
+class ArMember:
+    def __init__(self, f, name, size):
+        self.f = f
+        self.name = name
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+
+def ar_members(f):
+    if f.read(8) != b'!<arch>\n':
+        raise IOError('not an ar archive')
+    while True:
+        header = f.read(60)
+        if len(header) < 60:
+            return
+        name = header[:16].decode('ascii').strip().rstrip('/')
+        size = int(header[48:58])
+        member = ArMember(f, name, size)
+        yield member
+        # skip whatever the consumer left unread, members are 2-byte aligned
+        while member.remaining > 0:
+            member.read(1 << 20)
+        if size % 2 == 1:
+            f.read(1)
+
+def open_tar(member):
+    if member.name.endswith('.zst'):
+        # no zstd in the standard library, hand it to the command line tool
+        data = subprocess.run(['zstd', '-dc'], input=member.read(), stdout=subprocess.PIPE, check=True).stdout
+        return tarfile.open(fileobj=io.BytesIO(data), mode='r:')
+    return tarfile.open(fileobj=member, mode='r|*')
+
+def safe_path(dest, name):
+    name = os.path.normpath(name.lstrip('./'))
+    if name.startswith('..') or os.path.isabs(name):
+        return None
+    return os.path.join(dest, name)
+
+def extract_member(tar, info, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if info.issym():
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(info.linkname, path)
+        return
+    src = tar.extractfile(info)
+    with open(path, 'wb') as out:
+        shutil.copyfileobj(src, out, 1 << 20)
+    os.chmod(path, info.mode & 0o777)
+
+# Pulls control and the lib*.so* members out of a .deb without writing the
+# rest of the package to disk. Libraries land under debhome/tmp like dpkg -x.
+def extract_deb(deb, debhome):
+    with open(deb, 'rb') as f:
+        for member in ar_members(f):
+            if member.name.startswith('control.tar'):
+                with open_tar(member) as tar:
+                    for info in tar:
+                        if info.isfile() and info.name.lstrip('./') == 'control':
+                            extract_member(tar, info, os.path.join(debhome, 'control'))
+            elif member.name.startswith('data.tar'):
+                with open_tar(member) as tar:
+                    for info in tar:
+                        if not (info.isfile() or info.issym()):
+                            continue
+                        if not fnmatch.fnmatch(os.path.basename(info.name), 'lib*.so*'):
+                            continue
+                        path = safe_path(os.path.join(debhome, 'tmp'), info.name)
+                        if path is not None:
+                            extract_member(tar, info, path)
+
+def symbol_libs(debhome):
     added = set()
-    with open("symbols", "w") as f:
-        try:
-            subprocess.check_call(['dpkg', '-x', meta.package_deb, 'tmp']) 
-            libs = gather_libs("tmp")
-            for l in libs:
-                n = trim_libname(l)
-                if n in added:
-                    continue
-                subprocess.check_call(['dpkg-gensymbols', '-v0', '-p' + meta.package_name, '-e{}'.format(l), '-Osymbols-t'])
-                with open("symbols-t") as f2:
-                    f.write(f2.read())
-                added.add(n)
-                os.remove("symbols-t")
-            meta.has_symbols = True
-        except subprocess.CalledProcessError as err:
-            print(err)
-            print('failed to build symbols file for ' + meta.package_deb)
-    
-
-def extract_debs(debs,metas):
-    # Create some metadata about our little repository
-    home = os.getcwd()
-
-    for dep,deb in debs.items():
-        debhome = os.path.join(working_dir,dep)
-
-        if os.path.exists(debhome):
+    libs = []
+    for l in gather_libs(os.path.join(debhome, "tmp")):
+        n = trim_libname(l)
+        # symlinks to files we did not extract
+        if n in added or not os.path.exists(l):
             continue
+        added.add(n)
+        libs.append(l)
+    return libs
 
-        os.mkdir(debhome)
-        os.rename(os.path.join(working_dir,deb),os.path.join(debhome,deb))
-        os.chdir(debhome)
-
-        print('Extracting ' + deb)
-        out = subprocess.check_output(['ar', '-xv', deb])
-
-        if os.path.exists("control.tar.xz"):
-            out = subprocess.check_output(['tar', 'xf', 'control.tar.xz'])
-        elif os.path.exists("control.tar.gz"):
-            out = subprocess.check_output(['tar', '-xzf', 'control.tar.gz'])
-
-
-        # Test for symbol file
-        if (os.path.exists('symbols')):
-            os.remove('symbols')
-        meta = Meta(dep, deb, False, [])
-        build_symbols(meta)
-
-        metas[deb] = meta
-
-        os.chdir(home) 
-
-def parse_symbols(meta,symbols):
-    # We'll point every symbol to its metadata for now
-    # Build a true repo later
+# Same layout as a dpkg-gensymbols symbols file, read straight from .dynsym
+def gensymbols(package_name, lib):
+    start = time.time()
+    info = elfsym.read_elf(lib, cache=False)
+    if info is None or info.soname is None:
+        return "", time.time() - start
+
+    lines = ["{} {} #MINVER#\n".format(info.soname, package_name)]
+    for s in sorted(info.exports(), key=lambda s: (s.name, s.version or "")):
+        lines.append(" {}@{} 0\n".format(s.name, s.version or "Base"))
+    return "".join(lines), time.time() - start
+
+def write_symbols(meta, debhome, libs, results):
+    with open(os.path.join(debhome, "symbols"), "w") as f:
+        for l, result in zip(libs, results):
+            table, elapsed = result.get()
+            print('\t{} {:.3f}s'.format(l.split("/")[-1], elapsed))
+            f.write(table)
+        meta.has_symbols = True
+    store_cached(meta, debhome)
 
-    with open(os.path.join(working_dir, meta.package_name, "symbols")) as f:
-        current_lib = ""
-        for l in f.readlines():
+def extract_debs(debs,metas):
+    # Create some metadata about our little repository
+    start = time.time()
+    nlibs = 0
+    extracting = {}
+    building = []
+
+    def schedule(future):
+        nonlocal nlibs
+        meta, debhome = extracting.pop(future)
+        try:
+            future.result()
+        except (IOError, tarfile.TarError, subprocess.CalledProcessError) as err:
+            print(err)
+            print('failed to extract ' + meta.package_deb)
+            return
+        libs = symbol_libs(debhome)
+        nlibs += len(libs)
+        building.append((meta, debhome, libs, [procs.apply_async(gensymbols, (meta.package_name, l)) for l in libs]))
+
+    # Packages are extracted by threads and their symbol files built by
+    # processes, since parsing ELF holds the GIL. Both start while later
+    # packages are still downloading. The processes are forked before any
+    # extraction thread runs.
+    with Pool(options.workers) as procs, ThreadPoolExecutor(max_workers=options.workers) as pool:
+        for dep,deb,sha256 in debs:
+            debhome = os.path.join(working_dir,dep)
+
+            if up_to_date(dep, sha256, metas):
+                if deb is not None:
+                    os.remove(os.path.join(working_dir,deb))
+                continue
+
+            # Left over from another version of the package
+            if os.path.exists(debhome):
+                shutil.rmtree(debhome)
+            os.mkdir(debhome)
+
+            if cached(sha256):
+                meta = restore_cached(sha256, debhome)
+                meta.package_name = dep
+                if deb is not None:
+                    os.remove(os.path.join(working_dir,deb))
+                print('Cached ' + meta.package_deb)
+                metas[dep] = meta
+                continue
+
+            os.rename(os.path.join(working_dir,deb),os.path.join(debhome,deb))
+
+            print('Extracting ' + deb)
+            meta = Meta(dep, deb, False, [], sha256)
+            metas[dep] = meta
+            extracting[pool.submit(extract_deb, os.path.join(debhome, deb), debhome)] = (meta, debhome)
+
+            for future in [f for f in extracting if f.done()]:
+                schedule(future)
+
+        for future in as_completed(list(extracting)):
+            schedule(future)
+
+        for meta, debhome, libs, results in building:
+            print('Symbols for ' + meta.package_name)
+            write_symbols(meta, debhome, libs, results)
+
+    if len(building) > 0:
+        print('Built symbols for {} libraries of {} packages in {:.2f}s'.format(nlibs, len(building), time.time() - start))
+
+# Streams one package's symbols file into [(lib, [symbol names])]
+def parse_symbols(path):
+    tables = []
+    names = []
+    with open(path) as f:
+        for l in f:
             if l[0] != " " and l[0] != "|" and l[0] != '*':
-                current_lib = l.split()[0]
-                meta.add_lib(current_lib)
+                names = []
+                tables.append((l.split()[0], names))
             else:
                 toks = l.split()
                 if toks[0] == "|" or toks[0] == "*":
                     pass
                 else:
-                    name = toks[0].split("@")[0]
-                    if name in symbols:
-                        # Possible conflict (really only an issue between packages for now)
-                        symbols[name].libs.append(current_lib)
-                        symbols[name].metas.append(meta)
-                    else:    
-                        symbols[name] = Symbol(name,[current_lib],[meta])
-        
+                    names.append(toks[0].split("@")[0])
+    return tables
+
+# Runs sharing a working directory take turns updating it
+@contextmanager
+def repository_lock():
+    with open(os.path.join(working_dir, '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, mode) as f:
+        yield f
+    os.replace(tmp, path)
 
 def load_meta():
+    # meta.txt is append-only between rewrites, the last line for a package wins
     metas = {}
     if os.path.exists(os.path.join(working_dir, 'meta.txt')):
         with open(os.path.join(working_dir, 'meta.txt'), 'r') as f:
@@ -179,16 +530,22 @@ def load_meta():
 
     return metas
 
-def save_meta(meta):
-    with open(os.path.join(working_dir,'meta.txt'), 'w') as f:
-        for k,m in metas.items():
-            f.write(json.dumps(m, cls=MetaEncoder) + '\n')
+def write_meta(f, metas):
+    for m in metas:
+        f.write(json.dumps(m, cls=MetaEncoder) + '\n')
+
+def write_packages(f, metas):
+    for m in metas:
+        for l in m.shared_libs:
+            f.write("{} {}\n".format(l, m.package_name)) 
+
+def save_meta(metas):
+    with atomic_write(os.path.join(working_dir,'meta.txt')) as f:
+        write_meta(f, metas.values())
 
-def save_packages(meta):
-    with open(os.path.join(working_dir,'packages.txt'), 'w') as f:
-        for k,m in metas.items():
-            for l in m.shared_libs:
-                f.write("{} {}\n".format(l, m.package_name)) 
+def save_packages(metas):
+    with atomic_write(os.path.join(working_dir,'packages.txt')) as f:
+        write_packages(f, metas.values())
 
 def exclude_symbol(exclude, libs):
     for e in exclude:
@@ -197,56 +554,225 @@ def exclude_symbol(exclude, libs):
                 return True
     return False
 
+# Packages are parsed on a process pool, merging in meta order keeps the
+# first definition of a symbol the same as a serial load
 def load_symbols(metas):
-    symbols = {}
-    
-    for k,m in metas.items():
-        if m.has_symbols:
-            parse_symbols(m, symbols)
+    symbols = SymbolTable()
+    todo = [m for m in metas if m.has_symbols]
+    paths = [os.path.join(working_dir, m.package_name, "symbols") for m in todo]
+
+    if options.workers > 1 and len(paths) > 1:
+        with Pool(min(options.workers, len(paths))) as pool:
+            for m, tables in zip(todo, pool.imap(parse_symbols, paths, chunksize=16)):
+                symbols.add_package(m, tables)
+    else:
+        for m, path in zip(todo, paths):
+            symbols.add_package(m, parse_symbols(path))
 
     return symbols
 
 def save_symbols(symbols):
-    with open(os.path.join(working_dir,'symbols.txt'), 'w') as f:
-        f.write("{}\n".format(len(symbols)))
-        for k,s in symbols.items():
-            if exclude_symbol(["libc.so"], s.libs):
-                continue 
-
-            f.write("{} {}\n".format(s.name, s.libs[0]))
-
-            #for l in s.libs:
-            #    f.write(" {}".format(l))
-            #f.write("\n")
-
-
-def load_trace(name):
-    calls = []
-    if os.path.exists(name):
-        with open(name, 'r') as f:
-            for line in f:
-                try:
-                    j = json.loads(line)
-                    calls.append(j)
-                except json.decoder.JSONDecodeError:
-                    continue
+    symdb.build(symbols, symdb.db_file(working_dir))
+
+    # Text copy for lzload, libc symbols are resolved by the loader itself
+    db = symdb.open_db(symdb.db_file(working_dir))
+    db.export_text(symdb.text_file(working_dir), ["libc.so"])
+
+# The repository files (meta.txt, packages.txt, symbols.txt and the symbol
+# databases) are derived from the per-package directories. manifest.json
+# records which packages they cover, the database segments to search and the
+# text file sizes, so a run that only adds packages appends to them and
+# writes one new segment. Anything else, or files that do not match the
+# manifest after an interrupted run, rebuilds the whole repository.
+def manifest_file():
+    return os.path.join(working_dir, 'manifest.json')
+
+def load_manifest():
+    if os.path.exists(manifest_file()):
+        with open(manifest_file(), 'r') as f:
+            return json.load(f)
+    return {"packages": {}, "segments": [], "next": 1, "sizes": {}}
+
+def text_sizes():
+    sizes = {}
+    for n in ['meta.txt', 'packages.txt', 'symbols.txt']:
+        path = os.path.join(working_dir, n)
+        sizes[n] = os.path.getsize(path) if os.path.exists(path) else -1
+    return sizes
+
+def save_manifest(manifest):
+    manifest["sizes"] = text_sizes()
+    with atomic_write(manifest_file()) as f:
+        json.dump(manifest, f)
+
+def package_stamp(meta):
+    path = os.path.join(working_dir, meta.package_name, "symbols")
+    mtime = os.stat(path).st_mtime_ns if meta.has_symbols and os.path.exists(path) else 0
+    return [meta.package_sha256, meta.has_symbols, mtime]
+
+def segment_files(manifest):
+    return [os.path.join(working_dir, s) for s in manifest["segments"]]
+
+def rebuild_repository(metas, manifest):
+    start = time.time()
+    save_symbols(load_symbols(metas.values()))
+    save_meta(metas)
+    save_packages(metas)
+
+    for f in segment_files(manifest):
+        if f != symdb.db_file(working_dir) and os.path.exists(f):
+            os.remove(f)
+    manifest["packages"] = {k: package_stamp(m) for k,m in metas.items()}
+    manifest["segments"] = [os.path.basename(symdb.db_file(working_dir))]
+    save_manifest(manifest)
+    print('Rebuilt repository of {} packages in {:.2f}s'.format(len(metas), time.time() - start))
+
+def append_repository(metas, added, manifest):
+    start = time.time()
+    older = symdb.open_layers(segment_files(manifest))
+    symbols = load_symbols(added)
+
+    segment = 'symbols.{}.db'.format(manifest["next"])
+    symdb.build(symbols, os.path.join(working_dir, segment))
+    db = symdb.open_db(os.path.join(working_dir, segment))
+    nsyms = db.append_text(symdb.text_file(working_dir), older, ["libc.so"])
+
+    with open(os.path.join(working_dir,'meta.txt'), 'a') as f:
+        write_meta(f, added)
+    with open(os.path.join(working_dir,'packages.txt'), 'a') as f:
+        write_packages(f, added)
+
+    for m in added:
+        manifest["packages"][m.package_name] = package_stamp(m)
+    manifest["segments"].append(segment)
+    manifest["next"] += 1
+    save_manifest(manifest)
+    print('Added {} packages and {} symbols to the repository in {:.2f}s'.format(len(added), nsyms, time.time() - start))
+
+def update_repository(metas):
+    manifest = load_manifest()
+    known = manifest["packages"]
+    added = [m for k,m in metas.items() if k not in known]
+    stale = [k for k,m in metas.items() if k in known and known[k] != package_stamp(m)]
+    stale += [k for k in known if k not in metas]
+
+    intact = len(manifest["segments"]) > 0 and manifest["sizes"] == text_sizes() \
+        and all(os.path.exists(f) for f in segment_files(manifest))
+    if not intact or len(stale) > 0 or len(manifest["segments"]) >= MAX_SEGMENTS:
+        rebuild_repository(metas, manifest)
+    elif len(added) > 0:
+        append_repository(metas, added, manifest)
+
+    return symdb.open_layers(segment_files(manifest))
+
+
+# Traces are analyzed in TRACE_CHUNK byte ranges on a process pool. The
+# workers are forked with the databases update_repository opened under the
+# repository lock, so a concurrent run replacing or removing segment files
+# does not change what they see, and stream their ranges. A line belongs to
+# the range it starts in.
+trace_db = None
+
+def use_trace_db(db):
+    global trace_db
+    trace_db = db
+
+def resolve_call(line):
+    try:
+        c = json.loads(line)
+    except ValueError:
+        return None
+    if c["indirect"]:
+        return None
+    return trace_db.get(c["fnptr"][1:])
+
+# package -> [offset of first call, lib, calls] for one range of the trace.
+# The same few thousand call lines repeat all over a trace, so lines are
+# resolved once and looked up by their bytes after that.
+def scan_trace(job):
+    name, start, end = job
+    used = {}
+    resolved = {}
+    with open(name, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            offset = pos
+            pos += len(line)
+            if line in resolved:
+                hit = resolved[line]
+            else:
+                if len(resolved) >= TRACE_CACHE:
+                    resolved.clear()
+                hit = resolved[line] = resolve_call(line)
+            if hit is None:
+                continue
+            lib, package = hit
+            u = used.get(package)
+            if u is None:
+                used[package] = [offset, lib, 1]
+            else:
+                u[2] += 1
+    return end - start, used
+
+def analyze_trace(name, db):
+    used = {}
+    if not os.path.exists(name):
+        return used
+
+    size = os.path.getsize(name)
+    jobs = [(name, s, min(s + TRACE_CHUNK, size)) for s in range(0, size, TRACE_CHUNK)]
+    start = time.time()
+    done = 0
+
+    def merge(part):
+        for package, (offset, lib, calls) in part.items():
+            u = used.get(package)
+            if u is None:
+                used[package] = [offset, lib, calls]
+            else:
+                if offset < u[0]:
+                    u[0], u[1] = offset, lib
+                u[2] += calls
+
+    def progress(nbytes):
+        nonlocal done
+        done += nbytes
+        elapsed = max(time.time() - start, 1e-6)
+        sys.stderr.write('\rtrace {:.0f}/{:.0f} MB, {:.1f} MB/s'.format(done / 1e6, size / 1e6, done / 1e6 / elapsed))
+        sys.stderr.flush()
+
+    if options.workers > 1 and len(jobs) > 1:
+        with Pool(min(options.workers, len(jobs)), use_trace_db, (db,)) as pool:
+            for nbytes, part in pool.imap_unordered(scan_trace, jobs):
+                merge(part)
+                progress(nbytes)
     else:
-        return {}
-
-    return calls
-
-def check_deps(metas,deps,symbols,calls):
+        use_trace_db(db)
+        for job in jobs:
+            nbytes, part = scan_trace(job)
+            merge(part)
+            progress(nbytes)
+
+    if size > 0:
+        sys.stderr.write('\n')
+    print('Analyzed {:.1f} MB of trace in {:.2f}s'.format(size / 1e6, time.time() - start))
+    return used
+
+def check_deps(metas,deps,db,trace):
     stats = {}
     for d in deps:
         stats[d] = None
 
-    for c in calls:
-        if c["indirect"]:
-            continue
-        fname = c["fnptr"][1:]
-        sym = symbols.get(fname)
-        if sym is not None:
-            stats[sym.metas[0].package_name] = sym.libs[0]
+    used = analyze_trace(trace, db)
+    for package in sorted(used, key=lambda p: used[p][0]):
+        offset, lib, calls = used[package]
+        stats[package] = (lib, calls)
 
     return stats
 
@@ -258,14 +784,14 @@ def dump_deps(stats,outfile):
 
     for d,t in stats.items():
         if t is not None:
-            used.append({"package_name":d, "shared_lib":t})
+            used.append({"package_name":d, "shared_lib":t[0], "calls":t[1]})
         else:
             notused.append(d)
 
     print('Package has ' + str(len(stats)) + ' tracked dependencies')
     print('Using ' + str(len(used)) + ':')
     for d in used:
-        print('\t' + d["package_name"] + ' ===> ' + d["shared_lib"])
+        print('\t' + d["package_name"] + ' ===> ' + d["shared_lib"] + ' ({} calls)'.format(d["calls"]))
 
     print('Not using ' + str(len(notused)) + ':')
     for d in notused:
@@ -285,32 +811,34 @@ parser.add_option('-d', '--dir', dest='working_dir', default='symbol-out', help=
 parser.add_option('-t', '--trace', dest='trace', help='load trace file DIR', metavar='TRACE')
 parser.add_option('-l', '--load', action='store_true', help='jump straight to loading the repository symbols')
 parser.add_option('-o', '--outfile', dest='outfile', default=None, help='dump json data to OUTFILE for post-processing', metavar='OUTFILE')
+parser.add_option('-j', '--jobs', dest='jobs', type='int', default=4, help='run up to JOBS apt-get downloads at once', metavar='JOBS')
+parser.add_option('-w', '--workers', dest='workers', type='int', default=os.cpu_count(), help='extract packages with WORKERS threads and build symbol files with WORKERS processes', metavar='WORKERS')
+parser.add_option('-m', '--mirror', dest='mirror', default=None, help='take .deb files from a local archive mirror in DIR instead of apt-get', metavar='DIR')
+parser.add_option('-c', '--cache', dest='cache', default=os.path.join(LZLOAD_PATH, 'symbol-cache'), help='share symbol files between working directories through the cache in DIR', metavar='DIR')
+parser.add_option('--no-cache', dest='cache', action='store_const', const=None, help='do not read or write the symbol cache')
 parser.add_option('-s', '--src', action='store_true', default=None, help='download source packages from dep file', metavar='SRC')
 
 (options, args) = parser.parse_args()
 
 working_dir = options.working_dir
 
-metas = load_meta()
-
 if len(args) < 1:
     print("error: must supply dependency-list")
     parser.print_usage()
     sys.exit(1)
 
-if not options.load:
+with repository_lock():
+    metas = load_meta()
     deps=read_dependency_list(args[0])
-    debs=download_deps(deps,metas)
-    extract_debs(debs,metas)
 
-symbols = load_symbols(metas)
-save_meta(metas)
-save_packages(metas)
-save_symbols(symbols)
+    if not options.load:
+        debs=download_deps(deps,metas)
+        extract_debs(debs,metas)
+
+    db = update_repository(metas)
 
 if options.trace is not None:
-    calls = load_trace(options.trace)
-    stats = check_deps(metas,deps,symbols,calls) 
+    stats = check_deps(metas,deps,db,options.trace)
     dump_deps(stats, options.outfile)
    
 
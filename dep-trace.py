@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 
+import asyncio
+import json
 import subprocess
 import os.path
+import re
+import shlex
+import shutil
 import sys
+import tempfile
 import time
 
 
 from optparse import OptionParser
 
+import fileowners
+
+LZLOAD_PATH=os.environ.get('LZLOAD_PATH', os.path.join(os.path.expanduser('~'), 'var', 'lib', 'lzload'))
+
 def read_dependency_list(name):
     deps = {}
     with open(name, 'r') as f:
@@ -15,55 +25,238 @@ def read_dependency_list(name):
             deps[d] = True
     return deps
 
-def sample(pid,libs):
-    lsof = subprocess.Popen(['lsof', '-p', pid], stdout=subprocess.PIPE)
-
+# Process tree of root, threads included. /proc/PID/task/TID/children is
+# only there with CONFIG_PROC_CHILDREN, otherwise the parent pid of every
+# process is read from /proc/*/stat.
+def child_pids(pid):
+    children = []
     try:
-        out = subprocess.check_output(['grep','lib'], stdin=lsof.stdout)
-    except:
-        return
-
-    for l in out.splitlines():
-        fulllib = str(l.split()[-1],'utf-8')
-        libname = fulllib.split('/')[-1]
-        
-        libs[libname] = fulllib
-
-
-def monitor_pid(pid,timeout,rate):
-    print("monitoring process " + pid)
-    target = timeout / 1000.0
-    freq = rate / 1000.0
-    elapsed=0.0
-
-    libs = {}
-    while elapsed < target:
-        sample(pid,libs)
-        time.sleep(freq)
-        elapsed += freq
-
-    return libs
-
-
-def monitor_process(process,rate):
-    print("monitoring process " + str(process.pid))
-    freq = rate / 1000.0
-
-    libs = {}
-    process.poll()
-    while process.returncode is None:
-        sample(str(process.pid),libs)
-        time.sleep(freq)
-        process.poll()
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                children.extend(f.read().split())
+    except FileNotFoundError:
+        return None
+    except OSError:
+        pass
+    return children
+
+def parent_pids():
+    parents = {}
+    for p in os.listdir('/proc'):
+        if not p.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(p)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm may contain spaces and parens, ppid follows the last ')'
+        parents.setdefault(stat[stat.rfind(')') + 2:].split()[1], []).append(p)
+    return parents
+
+def process_tree(root):
+    pids = []
+    todo = [str(root)]
+    parents = None
+    while todo:
+        pid = todo.pop()
+        pids.append(pid)
+        children = child_pids(pid) if parents is None else None
+        if children is None:
+            if parents is None:
+                parents = parent_pids()
+            children = parents.get(pid, [])
+        todo.extend(children)
+    return pids
+
+def mapped_libs(maps):
+    for l in maps.splitlines():
+        toks = l.split(None, 5)
+        if len(toks) < 6 or 'lib' not in toks[5] or not toks[5].startswith('/'):
+            continue
+        yield toks[5].rstrip()
 
-    return libs
+def alive(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except OSError:
+        return False
+    return stat[stat.rfind(')') + 2] != 'Z'
+
+# Samples the libraries a process maps from /proc/PID/maps. A process whose
+# maps did not change since its last sample is not parsed again. Keeps the
+# numbers to report the achieved rate and its own cost.
+class Sampler:
+    def __init__(self):
+        self.snapshots = {}
+        self.seen = {}
+        self.samples = 0
+        self.busy = 0.0
+        self.watched = 0.0
+        self.start = time.time()
+        self.pids = set()
+
+    # libraries pid mapped since its last sample
+    def sample_pid(self, pid):
+        t = time.perf_counter()
+        new = []
+        try:
+            with open('/proc/{}/maps'.format(pid), 'rb') as f:
+                maps = f.read()
+        except OSError:
+            maps = None
+        if maps is not None and self.snapshots.get(pid) != maps:
+            self.pids.add(pid)
+            self.snapshots[pid] = maps
+            seen = self.seen.setdefault(pid, set())
+            for fulllib in mapped_libs(maps.decode('utf-8', errors='replace')):
+                if fulllib not in seen:
+                    seen.add(fulllib)
+                    new.append(fulllib)
+        self.samples += 1
+        self.busy += time.perf_counter() - t
+        return new
+
+    def forget(self, pid, watched):
+        # pids get reused
+        self.snapshots.pop(pid, None)
+        self.seen.pop(pid, None)
+        self.watched += watched
+
+    def report(self, rate):
+        elapsed = max(time.time() - self.start, 1e-6)
+        watched = max(self.watched, 1e-6)
+        print('sampled {} processes {} times in {:.2f}s: {:.1f} samples/s per process of {:.1f} requested, {:.1f}% of one cpu spent sampling'.format(
+            len(self.pids), self.samples, elapsed, self.samples / watched, 1000.0 / rate, 100.0 * self.busy / elapsed))
+
+# Watches any number of process trees at once. Every process gets its own
+# task and deadline, the tree below every root is scanned each tick and new
+# descendants are attached as they appear, even after their parent exited.
+# With out set, every attach, new library and exit is written to it as a
+# JSON line the moment it is seen.
+class Monitor:
+    def __init__(self, rate, timeout, out=None):
+        self.freq = rate / 1000.0
+        self.timeout = None if timeout is None else timeout / 1000.0
+        self.out = out
+        self.sampler = Sampler()
+        self.libs = {}
+        self.tasks = {}
+        self.start = time.time()
+
+    def emit(self, event, pid, root, **fields):
+        if self.out is None:
+            return
+        record = {"time": round(time.time() - self.start, 6), "event": event, "pid": int(pid), "root": int(root)}
+        record.update(fields)
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    # Sleeps until the next tick of a fixed schedule, so the time spent
+    # sampling does not stretch the period. Missed ticks are skipped.
+    async def tick(self, start, n):
+        n += 1
+        delay = start + n * self.freq - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+            n = int((time.time() - start) / self.freq)
+        return n
+
+    async def watch(self, pid, root):
+        start = time.time()
+        deadline = None if self.timeout is None else start + self.timeout
+        self.emit("attach", pid, root)
+        n = 0
+        while alive(pid):
+            for fulllib in self.sampler.sample_pid(pid):
+                libname = fulllib.split('/')[-1]
+                self.libs.setdefault(libname, fulllib)
+                self.emit("lib", pid, root, lib=libname, path=fulllib)
+            if deadline is not None and time.time() >= deadline:
+                self.emit("deadline", pid, root)
+                break
+            n = await self.tick(start, n)
+        else:
+            self.emit("exit", pid, root)
+        self.sampler.forget(pid, time.time() - start)
+
+    async def follow(self, root):
+        root = str(root)
+        start = time.time()
+        mine = set()
+        n = 0
+        while True:
+            for pid in list(mine) + [root]:
+                if not alive(pid):
+                    continue
+                for child in process_tree(pid):
+                    if child not in self.tasks:
+                        self.tasks[child] = asyncio.create_task(self.watch(child, root))
+                        mine.add(child)
+            if not any(not self.tasks[p].done() for p in mine):
+                break
+            n = await self.tick(start, n)
+
+    async def run(self, pids, commands):
+        follows = []
+        for pid in pids:
+            print("monitoring process " + pid)
+            follows.append(self.follow(pid))
+        for c in commands:
+            print("executing " + c)
+            proc = await asyncio.create_subprocess_exec(*shlex.split(c))
+            print("monitoring process " + str(proc.pid))
+            follows.append(self.follow_process(proc))
+        await asyncio.gather(*follows)
+        self.sampler.report(self.freq * 1000.0)
+        return self.libs
+
+    async def follow_process(self, proc):
+        await self.follow(proc.pid)
+        # An exited program is reaped. One still running past its deadline
+        # is left running and not waited for.
+        if proc.returncode is None and (self.timeout is None or not alive(proc.pid)):
+            await proc.wait()
+
+def monitor(pids, commands, timeout, rate, jsonl):
+    out = None
+    if jsonl == '-':
+        out = sys.stdout
+    elif jsonl is not None:
+        out = open(jsonl, 'w')
+    try:
+        return asyncio.run(Monitor(rate, timeout, out).run(pids, commands))
+    finally:
+        if out is not None and out is not sys.stdout:
+            out.close()
 
 def dump_libs(libs):
     print('Process used ' + str(len(libs)) + ' libraries')
     for l,fullname in libs.items():
         print('\t' + str(fullname)) 
 
-def search_deps(libs,deps):
+def guess_dep(l, notused):
+    # We'll just look for 'libX' match for now
+    if 'lib' not in l:
+        return None
+    idx = l.find(".so")
+    if idx < 1:
+        return None
+    libby = l[:idx]
+    libby = libby.split('-')[0]
+
+    for d in notused:
+        if libby in d:
+            return d
+    return None
+
+# Libraries are matched to the package that owns them through the file
+# ownership index. Only libraries no package owns, like the ones built by
+# dep-src, fall back to matching the library name against the dependencies.
+def search_deps(libs,deps,owners):
     print('Package has ' + str(len(deps)) + ' transitive dependencies')
     for d in deps:
         print('\t' + d)
@@ -76,27 +269,22 @@ def search_deps(libs,deps):
     notused = deps.copy()
     used = {}
 
-    for l in libs:
-        # We'll just look for 'libX' match for now
-        if 'lib' not in l:
-            continue
-        idx = l.find(".so")
-        if idx < 1:
+    guessed = 0
+    for l,fullname in libs.items():
+        found = owners.owner(fullname)
+        if found is None:
+            found = guess_dep(l, notused)
+            guessed += found is not None
+        elif found not in deps:
             continue
-        libby = l[:idx]
-        libby = libby.split('-')[0]
-
-        found = None
-        
-        for d in notused:
-            if libby in d:
-                found = d
-                break
 
-        if found is not None:
-            notused.pop(found)
+        if found is not None and found not in used:
+            notused.pop(found, None)
             used[found] = l
 
+    if guessed > 0:
+        print('Matched {} libraries owned by no package by name'.format(guessed))
+
     print('Matched ' + str(len(used)) + ' dependencies')
     for d,l in used.items():
         print('\t' + str(d) + ' ==> ' + str(l))
@@ -106,37 +294,140 @@ def search_deps(libs,deps):
         print('\t' + str(d))
     
 
-def execute(procstr, rate):
-    print("executing " + procstr)
-    p = procstr.replace("'","").split()
-    proc = subprocess.Popen(p)
-    return monitor_process(proc,rate)
+# Event mode: the program runs with LD_DEBUG=libs,files and the dynamic
+# loader of every process it starts writes its own LD_DEBUG_OUTPUT.PID file.
+# The files are read while the program runs and each event is stamped with
+# the time it was read, so loads are exact and times are good to one tick.
+LD_EVENT = re.compile(r'^\s*(\d+):\s+(.*)$')
+
+class LoadEvents:
+    def __init__(self):
+        self.start = time.time()
+        self.offsets = {}
+        self.partial = {}
+        self.trying = {}
+        self.reason = {}
+        # pid -> [(seconds, "load" or "unload", path, reason)]
+        self.timelines = {}
+
+    def parse(self, t, line):
+        m = LD_EVENT.match(line)
+        if m is None:
+            return
+        pid, msg = m.group(1), m.group(2)
+        if msg.startswith('trying file='):
+            self.trying[pid] = msg[len('trying file='):].strip()
+        elif msg.startswith('file='):
+            name, _, what = msg[len('file='):].partition(';')
+            name = name.rsplit(' [', 1)[0]
+            what = what.strip()
+            if what.startswith('needed by') or what.startswith('dynamically loaded by'):
+                self.reason[pid] = what.rsplit(' [', 1)[0]
+            elif what.startswith('generating link map'):
+                path = name
+                tried = self.trying.pop(pid, None)
+                if not name.startswith('/') and tried is not None and tried.split('/')[-1] == name:
+                    path = tried
+                self.timelines.setdefault(pid, []).append((t, 'load', path, self.reason.pop(pid, None)))
+            elif what.startswith('destroying link map'):
+                self.timelines.setdefault(pid, []).append((t, 'unload', name, None))
+
+    def read(self, outdir):
+        t = time.time() - self.start
+        for fn in os.listdir(outdir):
+            path = os.path.join(outdir, fn)
+            with open(path, 'r', errors='replace') as f:
+                f.seek(self.offsets.get(fn, 0))
+                data = self.partial.pop(fn, '') + f.read()
+                self.offsets[fn] = f.tell()
+            lines = data.split('\n')
+            # keep a line the loader is still writing for the next read
+            if lines[-1]:
+                self.partial[fn] = lines[-1]
+            for l in lines[:-1]:
+                self.parse(t, l)
+
+    def libs(self):
+        libs = {}
+        for pid, events in self.timelines.items():
+            for t, what, path, reason in events:
+                if what == 'load':
+                    libs.setdefault(path.split('/')[-1], path)
+        return libs
+
+    def dump(self):
+        for pid in sorted(self.timelines, key=int):
+            print('process {}:'.format(pid))
+            for t, what, path, reason in self.timelines[pid]:
+                print('\t{:+.3f}s {} {}{}'.format(t, what, path, ' ({})'.format(reason) if reason else ''))
+
+def execute_events(commands, rate):
+    freq = rate / 1000.0
+
+    outdir = tempfile.mkdtemp(prefix='dep-trace.')
+    env = os.environ.copy()
+    env["LD_DEBUG"] = "libs,files"
+    env["LD_DEBUG_OUTPUT"] = os.path.join(outdir, "ld")
+
+    events = LoadEvents()
+    try:
+        procs = []
+        for c in commands:
+            print("executing " + c + " with loader events")
+            procs.append(subprocess.Popen(shlex.split(c), env=env))
+        while any(p.poll() is None for p in procs):
+            events.read(outdir)
+            time.sleep(freq)
+        events.read(outdir)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+    nevents = sum(len(e) for e in events.timelines.values())
+    print('{} loader events from {} processes'.format(nevents, len(events.timelines)))
+    events.dump()
+    return events.libs()
 
 usage = "usage: %prog [options] dependency-list"
 parser = OptionParser(usage=usage)
-parser.add_option('-p', '--pid', dest='pid', help='monitor running process PID', metavar='PID')
-parser.add_option('-e', '--execute', dest='execute', help='start and monitor PROGRAM', metavar='PROGRAM')
-parser.add_option('-t', '--timeout', dest='timeout', default=1000, help='monitor for TIME ms', metavar='TIME')
-parser.add_option('-r', '--rate', dest='rate', default=10, help='sample every TIME ms', metavar='TIME')
-parser.add_option('-d', '--dump', action='store_true', help='dump libs from lsof and exit')
+parser.add_option('-p', '--pid', dest='pids', action='append', default=[], help='monitor running process PID and its children, repeat for more', metavar='PID')
+parser.add_option('-e', '--execute', dest='commands', action='append', default=[], help='start and monitor PROGRAM and its children, repeat for more', metavar='PROGRAM')
+parser.add_option('-t', '--timeout', dest='timeout', type='float', default=None, help='monitor every process for at most TIME ms (default 1000 with -p, until exit with -e)', metavar='TIME')
+parser.add_option('-j', '--jsonl', dest='jsonl', default=None, help='stream attach, library and exit events to FILE as JSON lines (- for stdout)', metavar='FILE')
+parser.add_option('-r', '--rate', dest='rate', type='float', default=10, help='sample every TIME ms', metavar='TIME')
+parser.add_option('-d', '--dump', action='store_true', help='dump the libraries sampled from /proc/PID/maps and exit')
+parser.add_option('-o', '--owners', dest='owners', default=os.path.join(LZLOAD_PATH, 'owners.json'), help='keep the library ownership index in FILE', metavar='FILE')
+parser.add_option('-s', '--symbol-dir', dest='symbol_dirs', action='append', default=[], help='also index the libraries of the dep-symbol repository in DIR', metavar='DIR')
+parser.add_option('-E', '--events', action='store_true', help='with -e, record exact library loads from the dynamic loader instead of sampling')
 
 (options, args) = parser.parse_args()
 
-if ((not options.dump and len(args) < 1) or options.pid is None and options.execute is None) or (options.pid is not None and options.execute is not None):
-    print("error: must supply pid OR execute")
+if (not options.dump and len(args) < 1) or len(options.pids) + len(options.commands) == 0:
+    print("error: must supply pid or execute")
     parser.print_usage()
     sys.exit(1)
 
-if options.pid is not None:
-    libs = monitor_pid(options.pid,options.timeout,options.rate)
+if options.events and (len(options.commands) == 0 or len(options.pids) > 0):
+    print("error: loader events need execute")
+    parser.print_usage()
+    sys.exit(1)
+
+timeout = options.timeout
+if timeout is None and len(options.commands) == 0:
+    timeout = 1000
+
+if options.events:
+    libs = execute_events(options.commands,options.rate)
 else:
-    libs = execute(options.execute,options.rate)
+    libs = monitor(options.pids,options.commands,timeout,options.rate,options.jsonl)
 
 if options.dump:
     dump_libs(libs)
 else:
     deps=read_dependency_list(args[0])
-    search_deps(libs,deps)
+    start = time.time()
+    owners = fileowners.load_index(options.owners, symbol_dirs=options.symbol_dirs)
+    print('Indexed {} libraries in {:.2f}s'.format(len(owners), time.time() - start))
+    search_deps(libs,deps,owners)
 
 
 
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import time
+
+from optparse import OptionParser
+
+import fileowners
+
+LZLOAD_PATH=os.environ.get('LZLOAD_PATH', os.path.join(os.path.expanduser('~'), 'var', 'lib', 'lzload'))
+
+# One usage store for every application, workload and run. Evidence comes in
+# the formats the other tools write:
+#
+#   dep-symbol -o JSON    {"used": [{"package_name", "shared_lib", "calls"}], "notused": [...]}
+#   dep-trace stdout      "Matched N dependencies" / "Possibly N unused dependencies" lists
+#   dep-trace -j JSONL    one event per line, "lib" events name a loaded library
+#   lzload.trace[.PID]    one line of used packages, or "nodep" (runners/, scripts/fold.py)
+#
+# and .dep files give the dependencies an application could have used.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    app TEXT NOT NULL,
+    workload TEXT NOT NULL,
+    run TEXT NOT NULL,
+    ingested REAL NOT NULL,
+    UNIQUE (app, workload, run)
+);
+CREATE TABLE IF NOT EXISTS usage (
+    run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    package TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    lib TEXT,
+    calls INTEGER,
+    source TEXT NOT NULL,
+    PRIMARY KEY (run, package)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS usage_package ON usage (package, used);
+CREATE TABLE IF NOT EXISTS deps (
+    app TEXT NOT NULL,
+    package TEXT NOT NULL,
+    PRIMARY KEY (app, package)
+) WITHOUT ROWID;
+"""
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=60)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.execute("PRAGMA journal_mode = WAL")
+    db.executescript(SCHEMA)
+    return db
+
+def read_dependency_list(name):
+    deps = []
+    with open(name, 'r') as f:
+        for d in f.read().splitlines():
+            if d and not d.startswith('#'):
+                deps.append(d)
+    return deps
+
+# Each parser returns a list of (package, used, lib, calls)
+
+def parse_symbol_json(j):
+    records = []
+    for u in j.get("used", []):
+        records.append((u["package_name"], 1, u.get("shared_lib"), u.get("calls")))
+    for d in j.get("notused", []):
+        records.append((d, 0, None, None))
+    return records
+
+def parse_dep_trace(lines):
+    records = []
+    section = None
+    for l in lines:
+        if l.startswith('Matched '):
+            section = 'used'
+        elif l.startswith('Possibly '):
+            section = 'notused'
+        elif l.startswith('\t') and section is not None:
+            if section == 'used':
+                toks = l.strip().split(' ==> ')
+                records.append((toks[0], 1, toks[1] if len(toks) > 1 else None, None))
+            else:
+                records.append((l.strip(), 0, None, None))
+        else:
+            section = None
+    return records
+
+owner_index = None
+
+def owners():
+    global owner_index
+    if owner_index is None:
+        owner_index = fileowners.load_index(options.owners, symbol_dirs=options.symbol_dirs)
+    return owner_index
+
+# Libraries of "lib" events are matched to packages through the same
+# ownership index dep-trace uses, libraries no package owns are left out
+def parse_trace_jsonl(lines):
+    records = []
+    for l in lines:
+        try:
+            event = json.loads(l)
+        except ValueError:
+            # blank, or cut short when the trace was stopped
+            continue
+        if not isinstance(event, dict) or event.get("event") != "lib":
+            continue
+        package = owners().owner(event.get("path") or event.get("lib", ""))
+        if package is not None:
+            records.append((package, 1, event.get("lib"), None))
+    return records
+
+def parse_lzload_trace(lines):
+    records = []
+    for l in lines:
+        for d in l.split():
+            if d != "nodep":
+                records.append((d, 1, None, None))
+    return records
+
+def parse_file(path):
+    with open(path, 'r') as f:
+        text = f.read()
+
+    lines = text.splitlines()
+    if text.lstrip().startswith('{'):
+        try:
+            j = json.loads(text)
+        except ValueError:
+            j = None
+        if isinstance(j, dict) and ("used" in j or "notused" in j):
+            return 'dep-symbol', parse_symbol_json(j)
+        return 'dep-trace-jsonl', parse_trace_jsonl(lines)
+    if any(l.startswith('Matched ') for l in lines):
+        return 'dep-trace', parse_dep_trace(lines)
+    return 'lzload', parse_lzload_trace(lines)
+
+def run_id(db, app, workload, run):
+    db.execute("INSERT OR IGNORE INTO runs (app, workload, run, ingested) VALUES (?, ?, ?, ?)",
+               (app, workload, run, time.time()))
+    db.execute("UPDATE runs SET ingested = ? WHERE app = ? AND workload = ? AND run = ?",
+               (time.time(), app, workload, run))
+    return db.execute("SELECT id FROM runs WHERE app = ? AND workload = ? AND run = ?",
+                      (app, workload, run)).fetchone()[0]
+
+# Files ingested together under one run name are merged: a package is used if
+# any of them used it, as scripts/fold.py does for the per-process lzload
+# traces. Without a run name every file is its own run named after it.
+# Ingesting a run again replaces it.
+def ingest(db, app, workload, run, paths):
+    runs = {}
+    for p in paths:
+        runs.setdefault(run if run is not None else os.path.basename(p), []).append(p)
+
+    for name, files in runs.items():
+        merged = {}
+        for p in files:
+            fmt, records = parse_file(p)
+            print('ingesting {} ({}, {} packages) as {}/{}/{}'.format(p, fmt, len(records), app, workload, name))
+            for package, used, lib, calls in records:
+                old = merged.get(package)
+                if old is None:
+                    merged[package] = [used, lib, calls, fmt]
+                    continue
+                if used and not old[0]:
+                    old[0], old[1] = used, lib
+                if calls is not None:
+                    old[2] = (old[2] or 0) + calls
+
+        with db:
+            rid = run_id(db, app, workload, name)
+            db.execute("DELETE FROM usage WHERE run = ?", (rid,))
+            db.executemany("INSERT INTO usage (run, package, used, lib, calls, source) VALUES (?, ?, ?, ?, ?, ?)",
+                           [(rid, k, v[0], v[1], v[2], v[3]) for k, v in merged.items()])
+
+def ingest_deps(db, app, path):
+    deps = read_dependency_list(path)
+    with db:
+        db.execute("DELETE FROM deps WHERE app = ?", (app,))
+        db.executemany("INSERT OR IGNORE INTO deps (app, package) VALUES (?, ?)", [(app, d) for d in deps])
+    print('{} has {} dependencies'.format(app, len(deps)))
+
+def app_filter(apps):
+    return ' AND app IN ({})'.format(','.join('?' * len(apps))) if apps else '', list(apps)
+
+# Packages any of the apps could use: their .dep lists plus everything a run
+# of theirs reported on
+def known_packages(db, apps):
+    where, params = app_filter(apps)
+    rows = db.execute("SELECT package FROM deps WHERE 1" + where + \
+                      " UNION SELECT package FROM usage JOIN runs ON runs.id = usage.run WHERE 1" + where,
+                      params + params)
+    return set(r[0] for r in rows)
+
+def unused(db, apps):
+    where, params = app_filter(apps)
+    used = set(r[0] for r in db.execute("SELECT DISTINCT package FROM usage JOIN runs ON runs.id = usage.run "
+                                         "WHERE used = 1" + where, params))
+    return sorted(known_packages(db, apps) - used)
+
+def frequency(db, apps):
+    where, params = app_filter(apps)
+    nruns = db.execute("SELECT COUNT(*) FROM runs WHERE 1" + where, params).fetchone()[0]
+    counts = dict(db.execute("SELECT package, COUNT(*) FROM usage JOIN runs ON runs.id = usage.run "
+                             "WHERE used = 1" + where + " GROUP BY package", params))
+    rows = [(p, counts.get(p, 0)) for p in known_packages(db, apps)]
+    rows.sort(key=lambda r: (-r[1], r[0]))
+    return nruns, rows
+
+def list_runs(db, apps):
+    where, params = app_filter(apps)
+    return db.execute("SELECT app, workload, runs.run, SUM(used), COUNT(package) FROM runs LEFT JOIN usage ON runs.id = usage.run "
+                      "WHERE 1" + where + " GROUP BY runs.id ORDER BY app, workload, runs.run", params).fetchall()
+
+usage = "usage: %prog [options] [FILE...]"
+parser = OptionParser(usage=usage)
+parser.add_option('-D', '--db', dest='db', default='usage.db', help='use usage store FILE', metavar='FILE')
+parser.add_option('-a', '--app', dest='apps', action='append', default=[], help='application APP, repeat to query several', metavar='APP')
+parser.add_option('-w', '--workload', dest='workload', default='default', help='ingest FILEs as workload NAME', metavar='NAME')
+parser.add_option('-r', '--run', dest='run', default=None, help='ingest FILEs merged as run NAME (default: one run per file)', metavar='NAME')
+parser.add_option('-l', '--deps', dest='deps', default=None, help='record dependency-list FILE as the dependencies of APP', metavar='FILE')
+parser.add_option('-u', '--unused', action='store_true', help='list packages used by no run of the APPs')
+parser.add_option('-f', '--frequency', action='store_true', help='list how many runs of the APPs used each package')
+parser.add_option('-o', '--owners', dest='owners', default=os.path.join(LZLOAD_PATH, 'owners.json'), help='match dep-trace JSONL libraries to packages with the ownership index FILE', metavar='FILE')
+parser.add_option('-s', '--symbol-dir', dest='symbol_dirs', action='append', default=[], help='also index the libraries of the dep-symbol repository in DIR', metavar='DIR')
+parser.add_option('-R', '--runs', action='store_true', help='list the ingested runs')
+
+(options, args) = parser.parse_args()
+
+if (len(args) > 0 or options.deps is not None) and len(options.apps) != 1:
+    print("error: ingesting needs exactly one APP")
+    parser.print_usage()
+    sys.exit(1)
+
+db = connect(options.db)
+
+if options.deps is not None:
+    ingest_deps(db, options.apps[0], options.deps)
+
+if len(args) > 0:
+    ingest(db, options.apps[0], options.workload, options.run, args)
+
+if options.runs:
+    for app, workload, run, nused, npackages in list_runs(db, options.apps):
+        print('{}\t{}\t{}\t{} of {} packages used'.format(app, workload, run, nused or 0, npackages))
+
+if options.unused:
+    packages = unused(db, options.apps)
+    print('Used by no run: ' + str(len(packages)))
+    for p in packages:
+        print('\t' + p)
+
+if options.frequency:
+    nruns, rows = frequency(db, options.apps)
+    print('Usage across ' + str(nruns) + ' runs:')
+    for p, n in rows:
+        print('\t{}\t{}/{}'.format(p, n, nruns))
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+# Dependency graph shared by the dep-find tooling.
+#
+# Packages are numbered 0..n-1 and edges are kept in CSR form (offsets/edges
+# arrays). Transitive closures are answered on the condensation of the graph:
+# strongly connected components are collapsed once, and the closure of every
+# component is a python int used as a bitset. Bit positions are assigned so the
+# members of one component are contiguous, which makes the popcount of a
+# closure its size in packages.
+#
+# A graph can be saved as a flat binary file (see save()) and opened again with
+# mmap, so every tool on a box shares the same page-cache pages:
+#
+#   header        magic, version, #names, #packages, #edges, string table size
+#   name_offsets  u32[#names + 1], offsets of the names in the string table
+#   by_name       u32[#names], vertex ids sorted by name for lookups
+#   offsets       u32[#names + 1], CSR offsets into edges
+#   edges         u32[#edges]
+#   strings       utf-8 names
+#
+# Vertices 0..#packages-1 are the packages of the deps-file, the rest are
+# names that only appear as a dependency. Integers are little-endian.
+
+import json
+import mmap
+import os
+import os.path
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+
+MAGIC = b'DEPG'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIII')
+# component closures kept between queries, least recently used dropped first
+MEMO_SIZE = 4096
+# roots computed per pass by closures(), their bitsets are held until yielded
+CLOSURE_BATCH = 1024
+
+
+def graph_file(deps_file):
+    return '{}.graph'.format(os.path.splitext(deps_file)[0])
+
+
+def is_fresh(path, deps_file):
+    return os.path.exists(path) and \
+        (not os.path.exists(deps_file) or os.path.getmtime(path) >= os.path.getmtime(deps_file))
+
+
+def load_graph(deps_file):
+    store = graph_file(deps_file)
+    if is_fresh(store, deps_file):
+        return open_store(store)
+    with open(deps_file) as f:
+        return DepGraph.from_deps(json.load(f))
+
+
+def load_deps(deps_file):
+    # name -> list of dependencies, from the binary store when it is up to date
+    store = graph_file(deps_file)
+    if is_fresh(store, deps_file):
+        return open_store(store).deps()
+    with open(deps_file) as f:
+        return json.load(f)
+
+
+class StoreNames:
+    def __init__(self, mm, base, name_offsets):
+        self.mm = mm
+        self.base = base
+        self.name_offsets = name_offsets
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def raw(self, v):
+        return self.mm[self.base + self.name_offsets[v]:self.base + self.name_offsets[v + 1]]
+
+    def __getitem__(self, v):
+        if v < 0 or v >= len(self):
+            raise IndexError(v)
+        return str(self.raw(v), 'utf-8')
+
+    def __iter__(self):
+        for v in range(len(self)):
+            yield self[v]
+
+
+class StoreIndex:
+    # binary search over the sorted permutation, no dict is built
+    def __init__(self, names, by_name):
+        self.names = names
+        self.by_name = by_name
+
+    def get(self, name, default=None):
+        key = name.encode('utf-8')
+        lo, hi = 0, len(self.by_name)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = self.by_name[mid]
+            raw = self.names.raw(v)
+            if raw == key:
+                return v
+            if raw < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return default
+
+    def __getitem__(self, name):
+        v = self.get(name)
+        if v is None:
+            raise KeyError(name)
+        return v
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return len(self.by_name)
+
+
+class DepsView(Mapping):
+    # read-only stand-in for the dict loaded from deps.json
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, name):
+        v = self.graph.index.get(name)
+        if v is None or v >= self.graph.npackages:
+            raise KeyError(name)
+        names = self.graph.names
+        return [names[w] for w in self.graph.successors(v)]
+
+    def __iter__(self):
+        names = self.graph.names
+        for v in range(self.graph.npackages):
+            yield names[v]
+
+    def __len__(self):
+        return self.graph.npackages
+
+
+def open_store(filename):
+    if sys.byteorder != 'little':
+        raise ValueError('graph store needs a little-endian host: {}'.format(filename))
+
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, nnames, npackages, nedges, nstrings = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a dependency graph store: {}'.format(filename))
+
+    view = memoryview(mm)
+    pos = HEADER.size
+
+    def u32(count):
+        nonlocal pos
+        a = view[pos:pos + 4 * count].cast('I')
+        pos += 4 * count
+        return a
+
+    name_offsets = u32(nnames + 1)
+    by_name = u32(nnames)
+    offsets = u32(nnames + 1)
+    edges = u32(nedges)
+    if pos + nstrings > len(mm):
+        raise ValueError('truncated dependency graph store: {}'.format(filename))
+
+    names = StoreNames(mm, pos, name_offsets)
+    return DepGraph(names, offsets, edges, npackages, StoreIndex(names, by_name))
+
+
+class DepGraph:
+    def __init__(self, names, offsets, edges, npackages=None, index=None):
+        self.names = names
+        if index is None:
+            index = {name: i for i, name in enumerate(names)}
+        self.index = index
+        self.npackages = len(names) if npackages is None else npackages
+        self.offsets = offsets
+        self.edges = edges
+
+        self.comp = None
+        self.comp_offsets = None
+        self.comp_edges = None
+        self.comp_start = None
+        self.cyclic = None
+        self.order = None
+        self.indegree = None
+        self.memo = OrderedDict()
+
+    @staticmethod
+    def from_deps(deps):
+        names = []
+        index = {}
+
+        def vertex(name):
+            if name not in index:
+                index[name] = len(names)
+                names.append(name)
+            return index[name]
+
+        for name in deps:
+            vertex(name)
+
+        offsets = array('I', [0])
+        edges = array('I')
+        for i in range(len(deps)):
+            for d in deps[names[i]]:
+                edges.append(vertex(d))
+            offsets.append(len(edges))
+
+        # packages only seen as a dependency have no edges
+        for i in range(len(deps), len(names)):
+            offsets.append(len(edges))
+
+        return DepGraph(names, offsets, edges, len(deps), index)
+
+    def save(self, filename):
+        encoded = [name.encode('utf-8') for name in self.names]
+        name_offsets = array('I', [0])
+        for raw in encoded:
+            name_offsets.append(name_offsets[-1] + len(raw))
+        by_name = array('I', sorted(range(len(encoded)), key=encoded.__getitem__))
+        offsets = array('I', self.offsets)
+        edges = array('I', self.edges)
+        strings = b''.join(encoded)
+
+        # written aside and renamed, readers never see a partial file
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(encoded), self.npackages, len(edges), len(strings)))
+            for a in (name_offsets, by_name, offsets, edges):
+                if sys.byteorder != 'little':
+                    a.byteswap()
+                f.write(a.tobytes())
+            f.write(strings)
+        os.replace(tmp, filename)
+
+    def deps(self):
+        return DepsView(self)
+
+    def __len__(self):
+        return len(self.names)
+
+    def successors(self, v):
+        return self.edges[self.offsets[v]:self.offsets[v + 1]]
+
+    def to_deps(self):
+        return {name: [self.names[w] for w in self.successors(v)]
+                for v, name in enumerate(self.names) if self.offsets[v] != self.offsets[v + 1]}
+
+    def reverse(self):
+        # same vertex numbering with every edge flipped
+        n = len(self.names)
+        counts = array('I', [0]) * (n + 1)
+        for w in self.edges:
+            counts[w + 1] += 1
+        offsets = array('I', [0]) * (n + 1)
+        for v in range(n):
+            offsets[v + 1] = offsets[v] + counts[v + 1]
+
+        fill = array('I', offsets)
+        edges = array('I', [0]) * len(self.edges)
+        for v in range(n):
+            for w in self.edges[self.offsets[v]:self.offsets[v + 1]]:
+                edges[fill[w]] = v
+                fill[w] += 1
+
+        return DepGraph(self.names, offsets, edges, self.npackages, self.index)
+
+    def condense(self):
+        if self.comp is not None:
+            return
+
+        # iterative Tarjan, components come out sinks first, so every
+        # successor of a component has a smaller id than the component itself
+        n = len(self.names)
+        offsets = self.offsets
+        edges = self.edges
+        unvisited = 0xffffffff
+        comp = array('I', [unvisited]) * n
+        low = array('I', [0]) * n
+        num = array('I', [0]) * n
+        onstack = bytearray(n)
+        stack = []
+        members = []
+        counter = 1
+
+        for root in range(n):
+            if num[root] != 0:
+                continue
+            num[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            onstack[root] = 1
+            work = [(root, offsets[root])]
+            while work:
+                v, i = work[-1]
+                end = offsets[v + 1]
+                while i < end:
+                    w = edges[i]
+                    i += 1
+                    if num[w] == 0:
+                        break
+                    if onstack[w] and num[w] < low[v]:
+                        low[v] = num[w]
+                else:
+                    w = None
+
+                if w is not None:
+                    work[-1] = (v, i)
+                    num[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    onstack[w] = 1
+                    work.append((w, offsets[w]))
+                    continue
+
+                work.pop()
+                if work and low[v] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[v]
+
+                if low[v] == num[v]:
+                    c = len(members)
+                    group = []
+                    while True:
+                        w = stack.pop()
+                        onstack[w] = 0
+                        comp[w] = c
+                        group.append(w)
+                        if w == v:
+                            break
+                    members.append(group)
+
+        ncomps = len(members)
+        comp_offsets = array('I', [0])
+        comp_edges = array('I')
+        comp_start = array('I', [0])
+        cyclic = bytearray(ncomps)
+        order = array('I')
+        for c, group in enumerate(members):
+            succ = set()
+            for v in group:
+                order.append(v)
+                for w in edges[offsets[v]:offsets[v + 1]]:
+                    succ.add(comp[w])
+            if len(group) > 1 or c in succ:
+                cyclic[c] = 1
+            succ.discard(c)
+            comp_edges.extend(sorted(succ))
+            comp_offsets.append(len(comp_edges))
+            comp_start.append(len(order))
+
+        indegree = array('I', [0]) * ncomps
+        for s in comp_edges:
+            indegree[s] += 1
+
+        self.comp = comp
+        self.indegree = indegree
+        self.comp_offsets = comp_offsets
+        self.comp_edges = comp_edges
+        self.comp_start = comp_start
+        self.cyclic = cyclic
+        self.order = order
+
+    def ncomps(self):
+        self.condense()
+        return len(self.comp_start) - 1
+
+    def comp_mask(self, c):
+        start = self.comp_start[c]
+        return ((1 << (self.comp_start[c + 1] - start)) - 1) << start
+
+    def comp_bits(self, c):
+        # closure of component c including c itself, memoized
+        bits = self.memo.get(c)
+        if bits is None:
+            return self.comp_bits_many([c])[c]
+        self.memo.move_to_end(c)
+        return bits
+
+    def remember(self, c, bits):
+        self.memo[c] = bits
+        self.memo.move_to_end(c)
+        while len(self.memo) > MEMO_SIZE:
+            self.memo.popitem(last=False)
+
+    def comp_bits_many(self, roots):
+        # one pass over everything reachable from roots, so overlapping
+        # sub-closures are computed once; returns {root: closure}
+        memo = self.memo
+        comp_offsets = self.comp_offsets
+        comp_edges = self.comp_edges
+        roots = set(roots)
+        # closures of earlier passes this one builds on, held here so the
+        # memo can drop them meanwhile
+        known = {}
+        pending = set()
+        work = list(roots)
+        while work:
+            x = work.pop()
+            if x in pending or x in known:
+                continue
+            bits = memo.get(x)
+            if bits is not None:
+                memo.move_to_end(x)
+                known[x] = bits
+                continue
+            pending.add(x)
+            work.extend(comp_edges[comp_offsets[x]:comp_offsets[x + 1]])
+
+        # a closure is dropped as soon as its last user in this pass is done,
+        # only the shared ones and the roots go to the memo
+        refs = {}
+        for x in pending:
+            for s in comp_edges[comp_offsets[x]:comp_offsets[x + 1]]:
+                if s in pending:
+                    refs[s] = refs.get(s, 0) + 1
+
+        result = {r: known[r] for r in roots if r in known}
+        live = {}
+        for x in sorted(pending):
+            bits = self.comp_mask(x)
+            for s in comp_edges[comp_offsets[x]:comp_offsets[x + 1]]:
+                if s in known:
+                    bits |= known[s]
+                    continue
+                bits |= live[s]
+                refs[s] -= 1
+                if refs[s] == 0:
+                    del live[s]
+            if x in roots:
+                result[x] = bits
+            if self.indegree[x] > 1 or x in roots:
+                self.remember(x, bits)
+            if x in refs:
+                live[x] = bits
+        return result
+
+    def strict(self, c, bits):
+        # packages reachable from component c through at least one edge
+        if not self.cyclic[c]:
+            bits ^= self.comp_mask(c)
+        return bits
+
+    def strict_bits(self, c):
+        return self.strict(c, self.comp_bits(c))
+
+    def closure_bits(self, name):
+        self.condense()
+        v = self.index.get(name)
+        if v is None:
+            return 0
+        return self.strict_bits(self.comp[v])
+
+    def bits_to_names(self, bits):
+        names = self.names
+        order = self.order
+        result = []
+        raw = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+        for i, byte in enumerate(raw):
+            if byte == 0:
+                continue
+            base = i * 8
+            for j in range(8):
+                if byte >> j & 1:
+                    result.append(names[order[base + j]])
+        return result
+
+    def closure(self, name):
+        return self.bits_to_names(self.closure_bits(name))
+
+    def closures(self, names):
+        self.condense()
+        names = list(names)
+        for i in range(0, len(names), CLOSURE_BATCH):
+            batch = names[i:i + CLOSURE_BATCH]
+            comps = {}
+            for name in batch:
+                v = self.index.get(name)
+                if v is not None:
+                    comps[name] = self.comp[v]
+            found = self.comp_bits_many(comps.values())
+            for name in batch:
+                c = comps.get(name)
+                yield name, [] if c is None else self.bits_to_names(self.strict(c, found[c]))
+
+    def closure_sizes(self):
+        # closure size of every package in one sweep over the components;
+        # a component's bitset is dropped once all its predecessors used it
+        self.condense()
+        ncomps = self.ncomps()
+        comp_offsets = self.comp_offsets
+        comp_edges = self.comp_edges
+
+        refs = array('I', self.indegree)
+
+        live = {}
+        sizes = array('I', [0]) * len(self.names)
+        for c in range(ncomps):
+            strict = 0
+            for s in comp_edges[comp_offsets[c]:comp_offsets[c + 1]]:
+                strict |= live[s]
+                refs[s] -= 1
+                if refs[s] == 0:
+                    del live[s]
+
+            mask = self.comp_mask(c)
+            # int.bit_count() needs python 3.10
+            size = bin(strict | mask if self.cyclic[c] else strict).count("1")
+            for i in range(self.comp_start[c], self.comp_start[c + 1]):
+                sizes[self.order[i]] = size
+
+            if refs[c] > 0:
+                live[c] = strict | mask
+
+        return sizes
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# In-process reader for the dynamic symbol table of ELF shared objects.
+#
+# Only the section headers, the dynamic section, .dynsym, .dynstr and the GNU
+# version tables are touched, through mmap. The most recently read libraries
+# are cached by path and invalidated when the file's mtime or size changes, so
+# dep-src can ask the same library for its SONAME, exports and marker symbols
+# many times for the price of one parse. Callers that read every library once,
+# like dep-symbol, skip the cache.
+
+import mmap
+import os
+import struct
+import threading
+
+from collections import OrderedDict
+
+SHT_DYNAMIC = 6
+SHT_DYNSYM = 11
+SHT_GNU_VERDEF = 0x6ffffffd
+SHT_GNU_VERNEED = 0x6ffffffe
+SHT_GNU_VERSYM = 0x6fffffff
+
+DT_NULL = 0
+DT_SONAME = 14
+
+VER_FLG_BASE = 1
+VER_NDX_GLOBAL = 1
+
+STB_GLOBAL = 1
+STB_WEAK = 2
+STB_GNU_UNIQUE = 10
+SHN_UNDEF = 0
+
+# never part of a library's interface, dpkg-gensymbols skips them as well
+IGNORED = {"_init", "_fini", "_edata", "_end", "__bss_start", "__bss_end", "__end",
+           "_DYNAMIC", "_GLOBAL_OFFSET_TABLE_", "_PROCEDURE_LINKAGE_TABLE_",
+           "__bss_start__", "__bss_end__", "_bss_end__", "__end__"}
+
+# libraries whose symbol tables are kept
+CACHE_SIZE = 256
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class ElfSymbol:
+    __slots__ = ("name", "version", "defined", "binding", "type")
+
+    def __init__(self, name, version, defined, binding, type):
+        self.name = name
+        self.version = version
+        self.defined = defined
+        self.binding = binding
+        self.type = type
+
+    def exported(self):
+        return self.defined and self.binding in (STB_GLOBAL, STB_WEAK, STB_GNU_UNIQUE) \
+            and self.name not in IGNORED
+
+
+class ElfInfo:
+    def __init__(self, soname, symbols):
+        self.soname = soname
+        self.symbols = symbols
+
+    def exports(self):
+        return [s for s in self.symbols if s.exported()]
+
+    def grep(self, pattern):
+        return [s.name for s in self.symbols if pattern in s.name]
+
+    def has_symbol(self, pattern):
+        return any(pattern in s.name for s in self.symbols)
+
+
+def _cstr(data, offset):
+    end = data.find(b'\0', offset)
+    return data[offset:end].decode('utf-8', errors='replace')
+
+
+def parse(data):
+    if data[:4] != b'\x7fELF':
+        return None
+
+    is64 = data[4] == 2
+    endian = '<' if data[5] == 1 else '>'
+
+    if is64:
+        shoff, = struct.unpack_from(endian + 'Q', data, 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + 'HHH', data, 0x3a)
+        shdr = struct.Struct(endian + 'IIQQQQIIQQ')
+        sym = struct.Struct(endian + 'IBBHQQ')
+        dyn = struct.Struct(endian + 'qQ')
+    else:
+        shoff, = struct.unpack_from(endian + 'I', data, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + 'HHH', data, 0x2e)
+        shdr = struct.Struct(endian + 'IIIIIIIIII')
+        sym = struct.Struct(endian + 'IIIBBH')
+        dyn = struct.Struct(endian + 'iI')
+
+    # (type, offset, size, link, info)
+    sections = []
+    for i in range(shnum):
+        h = shdr.unpack_from(data, shoff + i * shentsize)
+        sections.append((h[1], h[4], h[5], h[6], h[7]))
+
+    def find(sh_type):
+        for s in sections:
+            if s[0] == sh_type:
+                return s
+        return None
+
+    soname = None
+    dynamic = find(SHT_DYNAMIC)
+    if dynamic is not None:
+        strtab = sections[dynamic[3]][1]
+        for off in range(dynamic[1], dynamic[1] + dynamic[2], dyn.size):
+            tag, val = dyn.unpack_from(data, off)
+            if tag == DT_NULL:
+                break
+            if tag == DT_SONAME:
+                soname = _cstr(data, strtab + val)
+
+    dynsym = find(SHT_DYNSYM)
+    if dynsym is None:
+        return ElfInfo(soname, [])
+    strtab = sections[dynsym[3]][1]
+
+    versions = {}
+    verdef = find(SHT_GNU_VERDEF)
+    if verdef is not None:
+        vstr = sections[verdef[3]][1]
+        off = verdef[1]
+        for _ in range(verdef[4]):
+            _, flags, ndx, cnt, _, aux, nxt = struct.unpack_from(endian + 'HHHHIII', data, off)
+            # the base entry only names the file, its symbols are unversioned
+            if cnt > 0 and not flags & VER_FLG_BASE:
+                name, = struct.unpack_from(endian + 'I', data, off + aux)
+                versions[ndx] = _cstr(data, vstr + name)
+            if nxt == 0:
+                break
+            off += nxt
+
+    verneed = find(SHT_GNU_VERNEED)
+    if verneed is not None:
+        vstr = sections[verneed[3]][1]
+        off = verneed[1]
+        for _ in range(verneed[4]):
+            _, cnt, _, aux, nxt = struct.unpack_from(endian + 'HHIII', data, off)
+            aoff = off + aux
+            for _ in range(cnt):
+                _, _, other, name, anext = struct.unpack_from(endian + 'IHHII', data, aoff)
+                versions[other] = _cstr(data, vstr + name)
+                if anext == 0:
+                    break
+                aoff += anext
+            if nxt == 0:
+                break
+            off += nxt
+
+    versym = find(SHT_GNU_VERSYM)
+    symbols = []
+    nsyms = dynsym[2] // sym.size
+    # entry 0 is the reserved null symbol
+    for i in range(1, nsyms):
+        fields = sym.unpack_from(data, dynsym[1] + i * sym.size)
+        if is64:
+            name, info, _, shndx = fields[0], fields[1], fields[2], fields[3]
+        else:
+            name, info, _, shndx = fields[0], fields[3], fields[4], fields[5]
+
+        version = None
+        if versym is not None:
+            ndx, = struct.unpack_from(endian + 'H', data, versym[1] + i * 2)
+            ndx &= 0x7fff
+            # 0 is local and 1 global, neither carries a version (@Base)
+            if ndx > VER_NDX_GLOBAL:
+                version = versions.get(ndx)
+
+        symbols.append(ElfSymbol(_cstr(data, strtab + name), version, shndx != SHN_UNDEF, info >> 4, info & 0xf))
+
+    return ElfInfo(soname, symbols)
+
+
+def read_elf(path, cache=True):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = os.path.realpath(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    if cache:
+        with _lock:
+            cached = _cache.get(key)
+            if cached is not None and cached[0] == stamp:
+                _cache.move_to_end(key)
+                return cached[1]
+
+    info = None
+    if st.st_size > 0:
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                info = parse(data)
+        except (OSError, ValueError, struct.error, IndexError):
+            info = None
+
+    if cache:
+        with _lock:
+            _cache[key] = (stamp, info)
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return info
+
+
+def soname(path):
+    info = read_elf(path)
+    return info.soname if info is not None else None
+
+
+def exports(path):
+    info = read_elf(path)
+    return info.exports() if info is not None else []
+
+
+def has_symbol(path, pattern):
+    info = read_elf(path)
+    return info is not None and info.has_symbol(pattern)
+
+
+def grep_symbols(path, pattern):
+    info = read_elf(path)
+    return info.grep(pattern) if info is not None else None
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# Which package owns a shared library.
+#
+# Built from the file lists dpkg keeps for installed packages
+# (/var/lib/dpkg/info/PACKAGE[:ARCH].list) and from the libraries dep-symbol
+# extracted into a symbol repository (DIR/PACKAGE/tmp/...). Packages dep-symbol
+# restored from its cache have nothing extracted, for them the .deb's file
+# list, if the .deb is there, and the SONAMEs in DIR/PACKAGE/symbols are used.
+# Only shared objects are indexed, by absolute path and by file name, which is
+# the SONAME for the libraries the loader resolves by name.
+#
+# The index is saved as JSON with the stamp of every source it was built
+# from, and only sources whose stamp changed are read again.
+
+import glob
+import json
+import os
+import os.path
+import subprocess
+
+import elfsym
+
+DPKG_INFO = '/var/lib/dpkg/info'
+VERSION = 1
+
+
+def is_library(path):
+    return '.so' in os.path.basename(path)
+
+
+def stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def read_list(path):
+    libs = []
+    with open(path, 'r', errors='replace') as f:
+        for l in f:
+            l = l.rstrip('\n')
+            if is_library(l):
+                libs.append(l)
+    return libs
+
+
+def walk_repo_package(tmp):
+    libs = []
+    for root, dirs, files in os.walk(tmp):
+        for f in dirs + files:
+            if is_library(f):
+                libs.append('/' + os.path.relpath(os.path.join(root, f), tmp))
+    return libs
+
+
+def read_deb(deb):
+    libs = []
+    try:
+        out = subprocess.run(['dpkg-deb', '-c', deb], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return libs
+    for l in out.stdout.decode('utf-8', errors='replace').splitlines():
+        # mode owner size date time ./path [-> target]
+        toks = l.split()
+        if len(toks) >= 6 and is_library(toks[5]):
+            libs.append(toks[5].lstrip('.'))
+    return libs
+
+
+def read_cached_package(symbols):
+    libs = []
+    for deb in glob.glob(os.path.join(os.path.dirname(symbols), '*.deb')):
+        libs.extend(read_deb(deb))
+    with open(symbols, 'r', errors='replace') as f:
+        for l in f:
+            # "SONAME PACKAGE #MINVER#" starts every library's table
+            if l and not l[0].isspace() and not l.startswith(('#', '|', '*')):
+                soname = l.split()[0]
+                if is_library(soname):
+                    libs.append(soname)
+    return libs
+
+
+# source path -> (package, reader)
+def find_sources(dpkg_info, symbol_dirs):
+    sources = {}
+    if dpkg_info is not None and os.path.isdir(dpkg_info):
+        for fn in os.listdir(dpkg_info):
+            if fn.endswith('.list'):
+                sources[os.path.join(dpkg_info, fn)] = (fn[:-len('.list')].split(':')[0], read_list)
+    for d in symbol_dirs:
+        if not os.path.isdir(d):
+            continue
+        for package in os.listdir(d):
+            tmp = os.path.join(d, package, 'tmp')
+            symbols = os.path.join(d, package, 'symbols')
+            if os.path.isdir(tmp):
+                sources[tmp] = (package, walk_repo_package)
+            elif os.path.isfile(symbols):
+                sources[symbols] = (package, read_cached_package)
+    return sources
+
+
+# /lib and /usr/lib are the same directory on merged-/usr systems, while
+# dpkg records whichever one the package shipped
+def path_variants(path):
+    yield path
+    if path.startswith('/usr/'):
+        yield path[len('/usr'):]
+    else:
+        yield '/usr' + path
+    real = os.path.realpath(path)
+    if real != path:
+        yield real
+
+
+class OwnerIndex:
+    def __init__(self, sources):
+        self.sources = sources
+        self.by_path = {}
+        self.by_name = {}
+        # installed packages first, so they win file name clashes
+        for src in sorted(sources, key=lambda s: not s.startswith(DPKG_INFO)):
+            entry = sources[src]
+            for path in entry["files"]:
+                if path.startswith('/'):
+                    self.by_path.setdefault(path, entry["package"])
+                self.by_name.setdefault(os.path.basename(path), entry["package"])
+
+    def owner(self, path):
+        if path.startswith('/'):
+            for p in path_variants(path):
+                package = self.by_path.get(p)
+                if package is not None:
+                    return package
+        package = self.by_name.get(os.path.basename(path))
+        if package is None and path.startswith('/'):
+            # a versioned file name, known by its SONAME
+            soname = elfsym.soname(path)
+            if soname is not None:
+                package = self.by_name.get(soname)
+        return package
+
+    def __len__(self):
+        return len(self.by_path)
+
+
+def load_index(filename, dpkg_info=DPKG_INFO, symbol_dirs=()):
+    old = {}
+    if filename is not None and os.path.exists(filename):
+        try:
+            with open(filename, 'r') as f:
+                saved = json.load(f)
+            if saved.get("version") == VERSION:
+                old = saved["sources"]
+        except ValueError:
+            old = {}
+
+    sources = {}
+    changed = False
+    for src, (package, reader) in find_sources(dpkg_info, symbol_dirs).items():
+        try:
+            st = stamp(src)
+        except OSError:
+            continue
+        entry = old.get(src)
+        if entry is None or entry["stamp"] != st or entry["package"] != package:
+            entry = {"stamp": st, "package": package, "files": reader(src)}
+            changed = True
+        sources[src] = entry
+
+    if filename is not None and (changed or len(sources) != len(old)):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({"version": VERSION, "sources": sources}, f)
+        os.replace(tmp, filename)
+
+    return OwnerIndex(sources)
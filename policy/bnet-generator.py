@@ -4,6 +4,8 @@ import json
 import os
 import graph_tool.all
 import math
+import numpy
+import sys
 import time
 import logging
 
@@ -13,6 +15,9 @@ REPO_HOME = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DEPS_PATH = os.path.join(REPO_HOME, 'deps.json')
 POPCON_PATH = os.path.join(REPO_HOME, 'popcon-data')
 
+sys.path.insert(0, REPO_HOME)
+from depgraph import load_graph
+
 logging.basicConfig(
     filename='bnet-generator.log',
     filemode='w',
@@ -22,41 +27,33 @@ logging.basicConfig(
     datefmt="%H:%M:%S")
 
 
-def get_vertex(g, name2idx, v_prop, name):
-    if name in name2idx:
-        return name2idx[name]
-    v = g.add_vertex()
-    v_prop[v] = {'label': name}
-    idx = g.vertex_index[v]
-    name2idx[name] = idx
-    return idx
-
-
 blacklist = {'libc6'}
 
 
-def build(deps):
+def build(graph):
+    # vertex ids are the ids of the graph store, edges come straight from
+    # its CSR arrays without going through python lists
     g = graph_tool.Graph()
-    name2idx = {}
+    n = len(graph)
+    g.add_vertex(n)
     v_prop = g.new_vertex_property('object')
+    for v in range(n):
+        v_prop[g.vertex(v)] = {'label': graph.names[v]}
 
-    counter = 0
+    offsets = numpy.frombuffer(graph.offsets, dtype=numpy.uint32).astype(numpy.int64)
+    dst = numpy.frombuffer(graph.edges, dtype=numpy.uint32).astype(numpy.int64)
+    src = numpy.repeat(numpy.arange(n, dtype=numpy.int64), numpy.diff(offsets))
 
-    for name, depends in deps.items():
-        if name in blacklist:
-            continue
-        counter += 1
-        src = get_vertex(g, name2idx, v_prop, name)
-        edges = []
-        for dep_name in depends:
-            if dep_name in blacklist:
-                continue
-            dst = get_vertex(g, name2idx, v_prop, dep_name)
-            edges.append((src, dst))
-        g.add_edge_list(edges)
+    blocked = numpy.zeros(n, dtype=bool)
+    for name in blacklist:
+        v = graph.index.get(name)
+        if v is not None:
+            blocked[v] = True
+    keep = ~(blocked[src] | blocked[dst])
+    g.add_edge_list(numpy.stack([src[keep], dst[keep]], axis=1))
 
     g.vertex_properties['info'] = v_prop
-    return g, name2idx
+    return g, graph.index
 
 
 number_of_new_id = 0
@@ -379,9 +376,7 @@ def main():
     args = parser.parse_args()
     print('Building Bayesian network for {}...'.format(args.package))
     start = time.process_time()
-    with open(DEPS_PATH) as f:
-        deps = json.load(f)
-    g, name2idx = build(deps)
+    g, name2idx = build(load_graph(DEPS_PATH))
     reachable_nodes = compute_reachable_nodes(args, g, name2idx)
     result = generate_factor_graph(args, g, reachable_nodes)
     store_result(args, g, reachable_nodes, name2idx, result)
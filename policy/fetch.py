@@ -2,6 +2,7 @@
 
 import json
 import os
+import sys
 import requests
 import multiprocessing
 
@@ -11,6 +12,9 @@ POPCON_PATH = os.path.join(REPO_HOME, 'popcon-data')
 BLACKLIST_PATH = '{}/policy/blacklist.json'.format(REPO_HOME)
 url_prefix = 'https://qa.debian.org/cgi-bin/popcon-data?'
 
+sys.path.insert(0, REPO_HOME)
+from depgraph import load_deps
+
 count = 0
 total = 0
 
@@ -67,8 +71,7 @@ def init(l):
 
 def main():
     global total
-    with open(DEPS_PATH) as f:
-        deps = json.load(f)
+    deps = load_deps(DEPS_PATH)
     total = len(deps)
     lock = multiprocessing.Lock()
     pool = multiprocessing.Pool(initializer=init, initargs=(lock, ))
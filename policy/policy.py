@@ -16,6 +16,9 @@ REPO_HOME = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DEPS_PATH = os.path.join(REPO_HOME, 'deps.json')
 POPCON_PATH = os.path.join(REPO_HOME, 'popcon-data')
 
+sys.path.insert(0, REPO_HOME)
+from depgraph import load_deps
+
 logging.basicConfig(
     filename='policy.log',
     filemode='w',
@@ -183,8 +186,7 @@ def main():
     args = parser.parse_args()
     print('Installation policy for {}...'.format(args.package))
     start = time.process_time()
-    with open(DEPS_PATH) as f:
-        deps = json.load(f)
+    deps = load_deps(DEPS_PATH)
     if args.command == 'static':
         result = static_policy(args, deps)
     elif args.command == 'dynamic':
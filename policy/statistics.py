@@ -11,6 +11,9 @@ REPO_HOME = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DEPS_PATH = os.path.join(REPO_HOME, 'deps.json')
 POPCON_PATH = os.path.join(REPO_HOME, 'popcon-data')
 
+sys.path.insert(0, REPO_HOME)
+from depgraph import load_deps
+
 start_date = date(2004, 1, 1)
 end_date = date(2019, 10, 4)
 
@@ -52,8 +55,7 @@ def process_pkg(pkg):
 
 
 def main():
-    with open(DEPS_PATH) as f:
-        deps = json.load(f)
+    deps = load_deps(DEPS_PATH)
     count = 1
     for pkg in deps:
         print('[{}/{}] Processing {}...'.format(count, len(deps), pkg))
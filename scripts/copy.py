@@ -1,17 +1,26 @@
 #!/usr/bin/env python3
 
 import os.path
-import shutil
 import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import cowtree
+
 srcs = sys.argv[1]
 dest = sys.argv[2]
 deps = sys.argv[3]
 
-with open(deps, "r") as d:
-    for i in d.readlines():
-        for pat in ["", ".original", ".dpkg", ".make", ".vararg"]:
-            sp = os.path.join(srcs, i.strip() + pat)
-            if os.path.exists(sp):
-                print("Copying " + sp)
-                shutil.copytree(sp, os.path.join(dest, i.strip() + pat), symlinks=True)
+try:
+    with open(deps, "r") as d:
+        for i in d.readlines():
+            # variants sharing files with the source tree share them in dest too
+            links = {}
+            for pat in ["", ".original", ".dpkg", ".make", ".vararg"]:
+                sp = os.path.join(srcs, i.strip() + pat)
+                if os.path.exists(sp):
+                    # dep-src unmounts its overlay trees when it finishes
+                    cowtree.remount(os.path.join(srcs, i.strip()), sp)
+                    print("Copying " + sp)
+                    cowtree.copy_tree(sp, os.path.join(dest, i.strip() + pat), links)
+finally:
+    cowtree.unmount_overlays()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+# Symbol database shared by dep-symbol, dep-src and the runtime lookups.
+#
+# Every exported symbol maps to all the (library, package) pairs that provide
+# it, in the order they were found, the first one being the library lzload
+# binds to. The database is one flat file opened with mmap:
+#
+#   header          magic, version, #symbols, #strings, #providers,
+#                   #candidates, #buckets, string pool size
+#   string_offsets  u32[#strings + 1], offsets into the string pool
+#   cand_offsets    u32[#symbols + 1], offsets into candidates
+#   candidates      u32[#candidates], provider ids per symbol
+#   providers       u32[2 * #providers], (library, package) string ids
+#   buckets         u32[#buckets], open addressing hash of symbol id + 1
+#   strings         utf-8 string pool
+#
+# Strings 0..#symbols-1 are the symbol names in sorted order, libraries and
+# packages follow. Lookups hash the name with crc32 and probe linearly, so
+# nothing is parsed or built when the database is opened. Integers are
+# little-endian.
+#
+# A repository can be split into several databases that are searched in
+# order (see LayeredDB), so adding packages only writes a new small one.
+
+import mmap
+import os
+import os.path
+import struct
+import sys
+import zlib
+
+MAGIC = b'SYMD'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIIIII')
+# symbols.txt starts with a fixed width count so appends can patch it in place
+COUNT = '{:>10}\n'
+
+
+def db_file(working_dir):
+    return os.path.join(working_dir, 'symbols.db')
+
+
+def text_file(working_dir):
+    return os.path.join(working_dir, 'symbols.txt')
+
+
+def bucket_count(n):
+    nbuckets = 1
+    while nbuckets < 2 * n:
+        nbuckets <<= 1
+    return nbuckets
+
+
+def build(entries, filename):
+    # entries: symbol -> [(lib, package), ...], first pair is the default
+    names = sorted(entries)
+    strings = list(names)
+    string_ids = {}
+    providers = []
+    provider_ids = {}
+
+    def string(s):
+        i = string_ids.get(s)
+        if i is None:
+            i = string_ids[s] = len(strings)
+            strings.append(s)
+        return i
+
+    cand_offsets = [0]
+    cands = []
+    for name in names:
+        for pair in entries[name]:
+            p = provider_ids.get(pair)
+            if p is None:
+                p = provider_ids[pair] = len(providers)
+                providers.append(pair)
+            cands.append(p)
+        cand_offsets.append(len(cands))
+
+    flat = []
+    for lib, package in providers:
+        flat.append(string(lib))
+        flat.append(string(package))
+
+    pool = bytearray()
+    string_offsets = [0]
+    for s in strings:
+        pool += s.encode('utf-8')
+        string_offsets.append(len(pool))
+
+    nbuckets = bucket_count(len(names))
+    mask = nbuckets - 1
+    buckets = [0] * nbuckets
+    for i in range(len(names)):
+        raw = pool[string_offsets[i]:string_offsets[i + 1]]
+        b = zlib.crc32(raw) & mask
+        while buckets[b] != 0:
+            b = (b + 1) & mask
+        buckets[b] = i + 1
+
+    def u32(values):
+        return struct.pack('<{}I'.format(len(values)), *values)
+
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(names), len(strings), len(providers),
+                            len(cands), nbuckets, len(pool)))
+        f.write(u32(string_offsets))
+        f.write(u32(cand_offsets))
+        f.write(u32(cands))
+        f.write(u32(flat))
+        f.write(u32(buckets))
+        f.write(pool)
+    os.replace(tmp, filename)
+
+
+class SymbolDB:
+    def __init__(self, filename):
+        if sys.byteorder != 'little':
+            raise ValueError('symbol database needs a little-endian host: {}'.format(filename))
+
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, nsymbols, nstrings, nproviders, ncands, nbuckets, npool = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a symbol database: {}'.format(filename))
+
+        view = memoryview(self.mm)
+        pos = HEADER.size
+
+        def u32(count):
+            nonlocal pos
+            a = view[pos:pos + 4 * count].cast('I')
+            pos += 4 * count
+            return a
+
+        self.nsymbols = nsymbols
+        self.string_offsets = u32(nstrings + 1)
+        self.cand_offsets = u32(nsymbols + 1)
+        self.cands = u32(ncands)
+        self.providers = u32(2 * nproviders)
+        self.buckets = u32(nbuckets)
+        self.mask = nbuckets - 1
+        self.base = pos
+        if pos + npool > len(self.mm):
+            raise ValueError('truncated symbol database: {}'.format(filename))
+
+    def raw(self, i):
+        return self.mm[self.base + self.string_offsets[i]:self.base + self.string_offsets[i + 1]]
+
+    def string(self, i):
+        return str(self.raw(i), 'utf-8')
+
+    def find(self, name):
+        # symbol id of name, or None
+        if self.nsymbols == 0:
+            return None
+        key = name.encode('utf-8')
+        b = zlib.crc32(key) & self.mask
+        while True:
+            i = self.buckets[b]
+            if i == 0:
+                return None
+            if self.raw(i - 1) == key:
+                return i - 1
+            b = (b + 1) & self.mask
+
+    def candidates(self, i):
+        result = []
+        for c in self.cands[self.cand_offsets[i]:self.cand_offsets[i + 1]]:
+            result.append((self.string(self.providers[2 * c]), self.string(self.providers[2 * c + 1])))
+        return result
+
+    def lookup(self, name):
+        # every (lib, package) providing name, the default first
+        i = self.find(name)
+        if i is None:
+            return []
+        return self.candidates(i)
+
+    def get(self, name, default=None):
+        # (lib, package) lzload binds name to
+        i = self.find(name)
+        if i is None:
+            return default
+        c = self.cands[self.cand_offsets[i]]
+        return self.string(self.providers[2 * c]), self.string(self.providers[2 * c + 1])
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def __len__(self):
+        return self.nsymbols
+
+    def __iter__(self):
+        for i in range(self.nsymbols):
+            yield self.string(i)
+
+    def items(self):
+        for i in range(self.nsymbols):
+            yield self.string(i), self.candidates(i)
+
+    def conflicts(self):
+        # symbols provided by more than one library
+        for i in range(self.nsymbols):
+            if self.cand_offsets[i + 1] - self.cand_offsets[i] > 1:
+                yield self.string(i), self.candidates(i)
+
+    def entries(self):
+        return dict(self.items())
+
+    def text_lines(self, exclude=(), skip_names=()):
+        # "name lib" lines of symbols.txt, symbols any of whose libraries
+        # match exclude are left out
+        libs = [self.string(self.providers[2 * p]) for p in range(len(self.providers) // 2)]
+        skip = [any(e in lib for e in exclude) for lib in libs]
+        lines = []
+        for i in range(self.nsymbols):
+            cands = self.cands[self.cand_offsets[i]:self.cand_offsets[i + 1]]
+            if any(skip[c] for c in cands):
+                continue
+            name = self.string(i)
+            if name in skip_names:
+                continue
+            lines.append('{} {}\n'.format(name, libs[cands[0]]))
+        return lines
+
+    def export_text(self, filename, exclude=()):
+        # symbols.txt as lzload reads it: a count, then "name lib" lines
+        lines = self.text_lines(exclude)
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(COUNT.format(len(lines)))
+            f.writelines(lines)
+        os.replace(tmp, filename)
+
+    def append_text(self, filename, older, exclude=()):
+        # adds the symbols no older layer defines to an exported symbols.txt
+        lines = self.text_lines(exclude, older)
+        with open(filename, 'r+') as f:
+            count = int(f.readline())
+            f.seek(0, os.SEEK_END)
+            f.writelines(lines)
+            f.flush()
+            f.seek(0)
+            f.write(COUNT.format(count + len(lines)))
+        return len(lines)
+
+
+class LayeredDB:
+    # databases searched in order, the first one defining a symbol binds it
+    def __init__(self, dbs):
+        self.dbs = dbs
+
+    def filenames(self):
+        return [db.filename for db in self.dbs]
+
+    def get(self, name, default=None):
+        for db in self.dbs:
+            hit = db.get(name)
+            if hit is not None:
+                return hit
+        return default
+
+    def lookup(self, name):
+        cands = []
+        for db in self.dbs:
+            cands.extend(db.lookup(name))
+        return list(dict.fromkeys(cands))
+
+    def __contains__(self, name):
+        return any(name in db for db in self.dbs)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        if len(self.dbs) == 1:
+            yield from self.dbs[0]
+            return
+        seen = set()
+        for db in self.dbs:
+            for name in db:
+                if name not in seen:
+                    seen.add(name)
+                    yield name
+
+    def items(self):
+        for name in self:
+            yield name, self.lookup(name)
+
+    def conflicts(self):
+        for name, cands in self.items():
+            if len(cands) > 1:
+                yield name, cands
+
+    def entries(self):
+        return dict(self.items())
+
+
+def open_db(filename):
+    return SymbolDB(filename)
+
+
+def open_layers(filenames):
+    return LayeredDB([SymbolDB(f) for f in filenames])
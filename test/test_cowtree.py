@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# cowtree from several threads: dep-src clones the build trees of concurrent
+# builds next to each other in auto mode.
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import cowtree
+
+TREES = 8
+ROUNDS = 20
+
+
+def contents(root):
+    files = {}
+    for path, dirs, names in os.walk(root):
+        for n in names:
+            with open(os.path.join(path, n), 'rb') as f:
+                files[os.path.relpath(os.path.join(path, n), root)] = f.read()
+    return files
+
+
+class CloneTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, "src")
+        os.makedirs(os.path.join(self.src, "debian"))
+        for i in range(20):
+            with open(os.path.join(self.src, "file{}.c".format(i)), 'wb') as f:
+                f.write(os.urandom(i * 4096))
+        with open(os.path.join(self.src, "debian", "rules"), 'w') as f:
+            f.write("#!/usr/bin/make -f\n")
+
+    def tearDown(self):
+        for n in os.listdir(self.dir):
+            if n.startswith("tree") and os.path.ismount(os.path.join(self.dir, n)):
+                cowtree.remove_tree(os.path.join(self.dir, n))
+        shutil.rmtree(self.dir)
+
+    def clone_round(self, n):
+        dsts = [os.path.join(self.dir, "tree{}.{}".format(n, i)) for i in range(TREES)]
+        with ThreadPoolExecutor(max_workers=TREES) as pool:
+            counts = list(pool.map(lambda d: cowtree.clone_tree(self.src, d), dsts))
+        expected = contents(self.src)
+        for dst, count in zip(dsts, counts):
+            self.assertTrue(count)
+            self.assertEqual(contents(dst), expected)
+            cowtree.remove_tree(dst)
+
+    def test_concurrent_auto_clones(self):
+        # switch threads often so the probes interleave
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        for n in range(ROUNDS):
+            with self.subTest(round=n):
+                # probe again every round
+                cowtree._reflinks.clear()
+                self.clone_round(n)
+        # the reflink probes are gone
+        self.assertEqual([n for n in os.listdir(self.dir) if n.startswith(".reflink")], [])
+
+if __name__ == '__main__':
+    unittest.main()
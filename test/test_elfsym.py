@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# elfsym against binutils: the exports of versioned system libraries must
+# match what readelf --dyn-syms reports for them.
+
+import os.path
+import shutil
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import elfsym
+
+LIBS = ["/lib/x86_64-linux-gnu/libz.so.1", "/lib/x86_64-linux-gnu/libc.so.6",
+        "/usr/lib/x86_64-linux-gnu/libz.so.1", "/usr/lib/x86_64-linux-gnu/libc.so.6"]
+
+
+def readelf_exports(path):
+    # {(name, version or None)} of the defined global symbols
+    out = subprocess.run(['readelf', '--dyn-syms', '-W', path], stdout=subprocess.PIPE, check=True)
+    exports = set()
+    for l in out.stdout.decode('utf-8').splitlines():
+        toks = l.split()
+        if len(toks) < 8 or not toks[0].endswith(':'):
+            continue
+        bind, ndx, name = toks[4], toks[6], toks[7]
+        if ndx == 'UND' or bind not in ('GLOBAL', 'WEAK', 'UNIQUE'):
+            continue
+        name, _, version = name.replace('@@', '@').partition('@')
+        if name in elfsym.IGNORED:
+            continue
+        exports.add((name, version or None))
+    return exports
+
+
+class ExportsTest(unittest.TestCase):
+    def libraries(self):
+        libs = [l for l in LIBS if os.path.exists(l)]
+        if shutil.which('readelf') is None or len(libs) == 0:
+            self.skipTest('needs readelf and a versioned system library')
+        return libs
+
+    def test_exports_match_readelf(self):
+        for lib in self.libraries():
+            with self.subTest(lib=lib):
+                ours = set()
+                for s in elfsym.exports(lib):
+                    # readelf prints version definition symbols bare
+                    ours.add((s.name, None if s.version == s.name else s.version))
+                self.assertEqual(ours, readelf_exports(lib))
+
+    def test_base_version_is_unversioned(self):
+        for lib in self.libraries():
+            with self.subTest(lib=lib):
+                info = elfsym.read_elf(lib)
+                self.assertTrue(all(s.version != info.soname for s in info.exports()))
+
+
+if __name__ == '__main__':
+    unittest.main()